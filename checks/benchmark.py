@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""Benchmarks `checks.py` against synthetic repositories.
+
+Generates trees of files (with a configurable depth, fan-out, file type mix,
+number of third_party directories and exclude patterns), runs `checks.main()`
+on them in a separate process and measures the throughput, peak memory and
+number of syscalls.
+
+The peak memory is the largest of the checks process and its worker
+processes. The syscalls are counted with `strace -f -c` in one more run: all
+the calls of the checks process and its workers (`stat`, `openat`,
+`getdents64`, `read`, ...) including the Python start-up. Without `strace`
+the syscalls aren't counted.
+
+The results can be compared against the stored baselines in
+`benchmark_baseline.json`. The syscall counts and memory use are mostly
+independent of the machine, the throughput is only compared with a large
+tolerance.
+
+    ./benchmark.py                      # Run and compare to the baselines.
+    ./benchmark.py --update-baseline    # Store new baselines.
+"""
+
+
+import argparse
+import json
+import os
+import pathlib
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+__path__ = pathlib.Path(__file__).resolve().parent
+
+BASELINE_FILE = __path__ / 'benchmark_baseline.json'
+
+
+# Relative weights of the files generated, by extension.
+DEFAULT_MIX = {
+    '.v': 30,
+    '.sv': 10,
+    '.lef': 10,
+    '.py': 15,
+    '.sh': 5,
+    '.yml': 5,
+    '.txt': 15,
+    '.bin': 10,
+}
+
+SCENARIOS = {
+    'default': dict(depth=4, fanout=4, files=20, third_party=4, excludes=8),
+    'deep': dict(depth=8, fanout=2, files=5, third_party=0, excludes=8),
+    'many-excludes': dict(depth=3, fanout=4, files=20, third_party=0, excludes=200),
+    'third-party': dict(depth=2, fanout=4, files=10, third_party=64, excludes=8),
+}
+
+
+GOOD_HEADER = {
+    '.py': '#!/usr/bin/env python3\n# -*- coding: utf-8 -*-\n',
+    '.sh': '#!/bin/bash\n',
+}
+
+LICENSE_HEADER = """\
+{c} Copyright (C) 2022 F4PGA Authors
+{c}
+{c} Licensed under the Apache License, Version 2.0 (the "License");
+{c} you may not use this file except in compliance with the License.
+{c}
+{c} SPDX-License-Identifier: Apache-2.0
+"""
+
+COMMENT = {
+    '.v': '//',
+    '.sv': '//',
+    '.lef': '#',
+    '.py': '#',
+    '.sh': '#',
+    '.yml': '#',
+    '.txt': '#',
+}
+
+
+def file_contents(ext, rng, bad_ratio=0.1):
+    """Contents for a generated file, `bad_ratio` of them fail the checks.
+
+    >>> file_contents('.sh', random.Random(1), bad_ratio=0)[:12]
+    '#!/bin/bash\\n'
+    >>> b'\\0' in file_contents('.bin', random.Random(1))
+    True
+    """
+    if ext == '.bin':
+        return bytes(rng.randrange(256) for _ in range(256)) + b'\0'
+
+    header = ''
+    if rng.random() >= bad_ratio:
+        header = GOOD_HEADER.get(ext, '') + LICENSE_HEADER.format(c=COMMENT[ext])
+    body = '{} generated file\n'.format(COMMENT[ext]) * rng.randrange(1, 200)
+    return header + body
+
+
+def write_file(path, contents):
+    mode = 'wb' if isinstance(contents, bytes) else 'w'
+    with open(path, mode) as f:
+        f.write(contents)
+
+
+def choose_ext(rng, mix):
+    exts = sorted(mix)
+    return rng.choices(exts, weights=[mix[e] for e in exts])[0]
+
+
+def generate_tree(root, depth, fanout, files, third_party, excludes,
+                  mix=DEFAULT_MIX, seed=0):
+    """Generate a synthetic repository in `root`.
+
+    Creates a tree of directories `depth` levels deep with `fanout`
+    sub-directories each, with `files` files in each directory. Creates
+    `third_party` directories under `third_party/`, half of which are missing
+    a license file.
+
+    Returns the number of files generated and the environment variables
+    setting up `excludes` exclude patterns.
+    """
+    rng = random.Random(seed)
+    root = pathlib.Path(root)
+    count = 0
+
+    def fill(dpath, level):
+        nonlocal count
+        dpath.mkdir(parents=True, exist_ok=True)
+        for i in range(files):
+            ext = choose_ext(rng, mix)
+            write_file(dpath / 'file{}{}'.format(i, ext), file_contents(ext, rng))
+            count += 1
+        if level < depth:
+            for i in range(fanout):
+                fill(dpath / 'dir{}'.format(i), level + 1)
+
+    fill(root, 1)
+
+    for i in range(third_party):
+        dpath = root / 'third_party' / 'vendor{}'.format(i)
+        has_license = (i % 2) == 0
+        dpath.mkdir(parents=True)
+        if has_license:
+            write_file(dpath / 'LICENSE', 'Apache License\nVersion 2.0\n')
+        for j in range(files):
+            ext = choose_ext(rng, mix)
+            write_file(dpath / 'file{}{}'.format(j, ext), file_contents(ext, rng))
+
+    # Exclude patterns which don't match anything, so every path has to be
+    # checked against all of them.
+    patterns = ['*/nomatch{}/*'.format(i) for i in range(excludes)]
+    env = {
+        'INPUT_EXCLUDE_DIRECTORY': ' '.join(['.git', 'build'] + patterns),
+        'INPUT_EXCLUDE_LICENSE': ' '.join(patterns),
+        'INPUT_EXCLUDE_PYTHON': ' '.join(patterns),
+        'INPUT_THIRD_PARTY': 'third_party',
+    }
+    return count, env
+
+
+def parse_strace_summary(text):
+    """Parse the summary of `strace -c` into the number of calls per syscall.
+
+    >>> parse_strace_summary('''\\
+    ... % time     seconds  usecs/call     calls    errors syscall
+    ... ------ ----------- ----------- --------- --------- ----------------
+    ...  60.00    0.000060           2        30         3 newfstatat
+    ...  40.00    0.000040           1        40           getdents64
+    ... ------ ----------- ----------- --------- --------- ----------------
+    ... 100.00    0.000100           1        70         3 total
+    ... ''')
+    {'newfstatat': 30, 'getdents64': 40}
+    """
+    calls = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 5 or fields[-1] == 'total' or not fields[3].isdigit():
+            continue
+        calls[fields[-1]] = int(fields[3])
+    return calls
+
+
+def count_syscalls(cmd, **kw):
+    """Run `cmd` with `strace -f -c`, returning the number of calls per syscall.
+
+    Returns `None` when `strace` isn't available.
+    """
+    if shutil.which('strace') is None:
+        return None
+    with tempfile.NamedTemporaryFile('r', suffix='.strace') as f:
+        subprocess.run(
+            ['strace', '-f', '-c', '-o', f.name] + cmd, check=True,
+            stdout=subprocess.DEVNULL, **kw)
+        return parse_strace_summary(f.read())
+
+
+def measure(jobs, output):
+    """Run `checks.main()` in this process and write the measurements."""
+    sys.path.insert(0, str(__path__))
+    import checks
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            errors = checks.main(['checks.py', '--jobs', str(jobs)])
+        finally:
+            sys.stdout = stdout
+    wall = time.perf_counter() - start
+
+    results = {
+        'wall_time': wall,
+        'errors': errors,
+        # Kilobytes on Linux. The workers (with `--jobs`) have exited and
+        # been waited for once `main()` returns.
+        'max_rss_kb': max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    }
+    with open(output, 'w') as f:
+        json.dump(results, f)
+
+
+def run_scenario(name, params, jobs, repeat):
+    """Generate the tree for a scenario and measure the checks on it."""
+    tmpdir = tempfile.mkdtemp(prefix='f4pga-checks-bench-')
+    try:
+        tree = pathlib.Path(tmpdir) / 'repo'
+        nfiles, env_extra = generate_tree(tree, **params)
+        env = dict(os.environ)
+        env.update(env_extra)
+        env.pop('GITHUB_ACTIONS', None)
+
+        output = pathlib.Path(tmpdir) / 'result.json'
+        cmd = [sys.executable, __file__, '--measure', str(output), '--jobs', str(jobs)]
+        runs = []
+        for _ in range(repeat):
+            subprocess.run(cmd, cwd=tree, env=env, check=True)
+            with open(output) as f:
+                runs.append(json.load(f))
+        # strace slows the checks down, so it gets a run of its own.
+        syscalls = count_syscalls(cmd, cwd=tree, env=env)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    best = min(runs, key=lambda r: r['wall_time'])
+    result = {
+        'files': nfiles,
+        'errors': best['errors'],
+        'files_per_second': nfiles / best['wall_time'],
+        'max_rss_kb': max(r['max_rss_kb'] for r in runs),
+    }
+    if syscalls is not None:
+        result['syscalls_per_file'] = sum(syscalls.values()) / nfiles
+    return result
+
+
+def compare(name, result, baseline, time_tolerance, tolerance):
+    """Compare a result to its baseline, returning the regressions found.
+
+    >>> compare('x', {'files_per_second': 100, 'max_rss_kb': 10},
+    ...         {'files_per_second': 400, 'max_rss_kb': 10}, 3.0, 0.25)
+    ['x: files_per_second 100.0 is worse than baseline 400.0']
+    >>> compare('x', {'syscalls_per_file': 2.0}, {'syscalls_per_file': 1.0}, 3.0, 0.25)
+    ['x: syscalls_per_file 2.0 is worse than baseline 1.0']
+    """
+    regressions = []
+    checks = [
+        # metric, higher is better, allowed ratio
+        ('files_per_second', True, time_tolerance),
+        ('max_rss_kb', False, 1 + tolerance),
+        ('syscalls_per_file', False, 1 + tolerance),
+    ]
+    for metric, higher_better, ratio in checks:
+        if metric not in result or metric not in baseline:
+            continue
+        new, old = result[metric], baseline[metric]
+        if higher_better:
+            bad = new * ratio < old
+        else:
+            bad = new > old * ratio
+        if bad:
+            regressions.append('{}: {} {:.1f} is worse than baseline {:.1f}'.format(
+                name, metric, new, old))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'scenarios', nargs='*', default=sorted(SCENARIOS),
+        help='Scenarios to run (default: all of {}).'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of jobs to run the checks with (default: 1).')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of times to run each scenario, the fastest run is used.')
+    parser.add_argument('--baseline', default=str(BASELINE_FILE),
+        help='File with the stored baselines.')
+    parser.add_argument('--update-baseline', action='store_true',
+        help='Store the results as the new baselines.')
+    parser.add_argument('--time-tolerance', type=float, default=3.0,
+        help='Allowed slow down of the throughput (as it depends on the machine).')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='Allowed relative increase of the memory use and syscall counts.')
+    parser.add_argument('--json',
+        help='Write the results to this file.')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    opts = parser.parse_args(args[1:])
+
+    if opts.measure:
+        measure(opts.jobs, opts.measure)
+        return 0
+
+    results = {}
+    for name in opts.scenarios:
+        result = run_scenario(name, SCENARIOS[name], opts.jobs, opts.repeat)
+        results[name] = result
+        print('{:<16} {:>7} files {:>10.1f} files/s {:>8} KiB max rss {:>6} syscalls/file'.format(
+            name, result['files'], result['files_per_second'], result['max_rss_kb'],
+            '{:.2f}'.format(result['syscalls_per_file']) if 'syscalls_per_file' in result else '-'))
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if opts.update_baseline:
+        baselines = {}
+        if os.path.exists(opts.baseline):
+            with open(opts.baseline) as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(opts.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Updated', opts.baseline)
+        return 0
+
+    try:
+        with open(opts.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        print('No baselines found at', opts.baseline)
+        return 0
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baselines:
+            print('No baseline for', name)
+            continue
+        if result['errors'] != baselines[name]['errors']:
+            regressions.append('{}: found {} errors, baseline found {}'.format(
+                name, result['errors'], baselines[name]['errors']))
+        regressions += compare(
+            name, result, baselines[name], opts.time_tolerance, opts.tolerance)
+
+    for r in regressions:
+        print('::error::Benchmark regression -', r)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -18,13 +18,25 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+import argparse
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import json
 import logging
 import os
 import pathlib
+import posixpath
 import pprint
 import re
+import stat
+import subprocess
 import sys
 import tempfile
+import time
 
 
 __path__ = pathlib.Path(__file__).resolve().parent
@@ -36,15 +48,22 @@ ON_GITHUB_ACTIONS = (
 OUTPUT_ANNOTATIONS = (
     os.environ.get('INPUT_ANNOTATIONS', 'false').lower() in ('1', 'true'))
 
+TOOL_NAME = 'f4pga-checks'
+
 
 def relpath(fpath):
     """Convert the path to be relative to the current working directory."""
     assert isinstance(fpath, pathlib.Path), (fpath, type(fpath))
-    fpath = fpath.resolve()
+    # Paths found while walking the tree are already absolute and resolving
+    # them again is a syscall per path component.
+    if not fpath.is_absolute():
+        fpath = fpath.resolve()
     return os.path.relpath(fpath)
 
 
 def fdebug(fpath, msg, *args, **kw):
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
     return logging.debug('%s: '+msg, relpath(fpath), *args, **kw)
 
 
@@ -56,12 +75,16 @@ def fwarn(fpath, msg, *args, **kw):
     return logging.warning('%s: '+msg, relpath(fpath), *args, **kw)
 
 
+def excludes_env_name(etype):
+    if etype == 'third_party':
+        return 'INPUT_THIRD_PARTY'
+    return 'INPUT_EXCLUDE_{}'.format(etype.upper())
+
+
 def excludes(etype, dirs=False, _cache={}):
-    if etype not in _cache:
-        if etype == 'third_party':
-            env_name = 'INPUT_THIRD_PARTY'
-        else:
-            env_name = 'INPUT_EXCLUDE_{}'.format(etype.upper())
+    key = (etype, dirs)
+    if key not in _cache:
+        env_name = excludes_env_name(etype)
         raw_input_exclude = os.environ.get(env_name, '')
         logging.debug("%s = %r", env_name, raw_input_exclude)
 
@@ -84,20 +107,51 @@ def excludes(etype, dirs=False, _cache={}):
             input_exclude.sort()
 
         logging.debug('Excludes for %s are %s', etype, input_exclude)
-        _cache[etype] = input_exclude
-
-    return _cache[etype]
-
-
-def read_header(pname):
-    assert isinstance(pname, pathlib.Path), (pname, type(pname))
-    assert pname.is_file(), (pname, pname.stat())
-
-    # Read the first 4 kbytes
-    with open(pname) as f:
-        data = f.read(1024*4)
-
-    lines = data.splitlines(keepends=True)
+        _cache[key] = input_exclude
+
+    return _cache[key]
+
+
+# Number of characters at the start of a file which the checks look at,
+# unless a checker needs more (see `Checker`).
+HEADER_SIZE = 1024*4
+
+# utf-8 characters are at most 4 bytes.
+UTF8_MAX_BYTES = 4
+
+
+def decode_header(data, size=None):
+    r"""Decode the raw bytes of a file header into lines.
+
+    Only the first `size` characters are kept (after the line endings are
+    converted), like reading the file in text mode would. The last line is
+    removed if it isn't a full line, which also takes care of a utf-8
+    character cut in half at the end of the header. Line endings are
+    converted to `\n`. Invalid utf-8 is replaced with `\ufffd` rather than
+    raising an error, see `find_invalid_utf8`.
+
+    >>> decode_header(b'#!/bin/bash\r\n# SPDX\n# cut')
+    ['#!/bin/bash\n', '# SPDX\n']
+    >>> decode_header(b'one line')
+    ['one line']
+    >>> decode_header('a\nb\u00e9'.encode('utf-8')[:-1])
+    ['a\n']
+    >>> decode_header(b'# (c) \xa9 2022\n')
+    ['# (c) \ufffd 2022\n']
+    >>> data = '\u00e9\u00e9\r\n\u00e9\u00e9\n'.encode('utf-8')
+    >>> decode_header(data, 6) == ['\u00e9\u00e9\n'] * 2
+    True
+    >>> decode_header(data, 5) == ['\u00e9\u00e9\n']
+    True
+    """
+    # Decoding incrementally ignores an incomplete character at the end.
+    text = codecs.getincrementaldecoder('utf-8')(errors='replace').decode(
+        data, final=False)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if size is not None:
+        text = text[:size]
+
+    lines = text.splitlines(keepends=True)
     # Remove the last element if it isn't a full line.
     if len(lines) > 1:
         if lines[-1][-1] != '\n':
@@ -106,7 +160,125 @@ def read_header(pname):
     return lines
 
 
-def report_file_error(error_message, filename, lineno=1, wanted=None, found=None):
+def find_invalid_utf8(data):
+    r"""Find the first invalid utf-8 in the raw bytes of a file header.
+
+    Returns `None` if `data` is valid utf-8 (ignoring a character cut in half
+    at the end), otherwise a tuple of the line number and the invalid bytes.
+
+    >>> find_invalid_utf8(b'abc\n\xc3\xa9\n\xc3') is None
+    True
+    >>> find_invalid_utf8(b'abc\n# (c) \xa9 2022\n')
+    (2, b'\xa9')
+    """
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data, final=False)
+    except UnicodeDecodeError as e:
+        return data.count(b'\n', 0, e.start) + 1, data[e.start:e.end]
+    return None
+
+
+class FileContext:
+    """A file being checked, shared by all the checks run on the file.
+
+    The header of the file is read (as bytes) and decoded at most once, the
+    first time a check needs it. The header is the first
+    `FileType.header_size` characters of the file.
+    """
+
+    def __init__(self, path, ftype=None):
+        assert isinstance(path, pathlib.Path), (path, type(path))
+        self.path = path
+        self.ftype = ftype
+        self._header_bytes = None
+        self._header_lines = None
+
+    def __repr__(self):
+        return 'FileContext({!r})'.format(self.path)
+
+    @property
+    def header_bytes(self):
+        """The bytes holding the first `FileType.header_size` characters."""
+        if self._header_bytes is None:
+            with profile_phase('read header'), open(self.path, 'rb') as f:
+                self._header_bytes = f.read(self.header_size * UTF8_MAX_BYTES)
+        return self._header_bytes
+
+    @property
+    def header_size(self):
+        return self.ftype.header_size if self.ftype is not None else HEADER_SIZE
+
+    @property
+    def is_binary(self):
+        """Does the file look like a binary file (has NUL bytes)?"""
+        return b'\0' in self.header_bytes
+
+    @property
+    def header_lines(self):
+        """The full lines in the header of the file.
+
+        Returns a new list on each access as some checks modify it.
+        """
+        if self._header_lines is None:
+            header_bytes = self.header_bytes
+            with profile_phase('decode header'):
+                self._header_lines = decode_header(header_bytes, self.header_size)
+        return list(self._header_lines)
+
+
+# Identifiers and descriptions of the problems which are reported.
+RULES = {
+    'header-encoding': 'The header of the file is not valid utf-8.',
+    'file-unreadable': 'The file could not be read.',
+    'license-spdx': 'The header of the file has a SPDX-License-Identifier line.',
+    'license-spdx-invalid': 'The SPDX-License-Identifier is a valid SPDX license expression.',
+    'license-copyright': 'The header of the file has a copyright line with valid years.',
+    'license-header': 'The header of the file has the full license notice.',
+    'python-shebang': 'Python files start with a `#!/usr/bin/env python3` line.',
+    'python-coding': 'Python files set the utf-8 coding on the second line.',
+    'shell-shebang': 'Shell scripts start with a bash or sh `#!` line.',
+    'third-party-license': 'Each third party directory has a license file.',
+    'third-party-license-unknown': 'The license of each third party directory can be identified.',
+    'third-party-license-not-allowed': 'Third party directories use one of the allowed licenses.',
+}
+
+
+class Finding(collections.namedtuple('Finding', 'path line rule message')):
+    """A problem found by the checks.
+
+    `path` is relative to the current directory (or `None` when the problem
+    isn't about a file) and `line` is `None` for problems with the whole file
+    or directory.
+    """
+
+    def to_json(self):
+        return json.dumps(self._asdict(), sort_keys=True)
+
+
+# When set to a list, every reported problem is also appended to it as a
+# `Finding`, see `recording_findings`.
+_recorded_findings = None
+
+
+@contextlib.contextmanager
+def recording_findings():
+    """Context collecting the `Finding`s reported inside it.
+
+    >>> with recording_findings() as findings:
+    ...     _ = report_file_error('Oops', pathlib.Path('a.py'), 2, rule='oops')
+    >>> findings
+    [Finding(path='a.py', line=2, rule='oops', message='Oops')]
+    """
+    global _recorded_findings
+    previous = _recorded_findings
+    _recorded_findings = findings = []
+    try:
+        yield findings
+    finally:
+        _recorded_findings = previous
+
+
+def report_file_error(error_message, filename, lineno=1, wanted=None, found=None, rule=None):
     assert lineno > 0, f'Line numbers start at 1, got {lineno}'
     if wanted is not None:
         assert found is not None, (wanted, found)
@@ -117,45 +289,66 @@ def report_file_error(error_message, filename, lineno=1, wanted=None, found=None
     if isinstance(filename, pathlib.Path) and filename.is_absolute():
         filename = pathlib.Path(os.path.relpath(filename))
 
-    fwarn(filename, 'Error on line %s: %s', lineno, full_error)
-    if ON_GITHUB_ACTIONS:
-        print(':error file={},line={},col=0:{}'.format(filename, lineno, full_error))
+    # While recording, the findings are output by the reporters and the error
+    # summary, so they are only logged when debugging.
+    if _recorded_findings is not None:
+        fdebug(filename, 'Error on line %s: %s', lineno, full_error)
+        _recorded_findings.append(Finding(
+            pathlib.PurePath(filename).as_posix(), lineno, rule, full_error))
+    else:
+        fwarn(filename, 'Error on line %s: %s', lineno, full_error)
+        if ON_GITHUB_ACTIONS:
+            print(':error file={},line={},col=0:{}'.format(filename, lineno, full_error))
     return [full_error]
 
 
-def report_error(error_message):
-    logging.warning(error_message)
-    print(f'::error::{error_message}')
+def report_error(error_message, rule=None, filename=None):
+    # While recording, the findings are output by the reporters and the error
+    # summary, so they are only logged when debugging.
+    if _recorded_findings is not None:
+        logging.debug(error_message)
+        if filename is not None:
+            filename = pathlib.PurePath(relpath(filename)).as_posix()
+        _recorded_findings.append(Finding(filename, None, rule, error_message))
+    else:
+        logging.warning(error_message)
+        print(f'::error::{error_message}')
     return [error_message]
 
 
+SHELL_SHEBANG_LINES = [
+    '#!/bin/bash',
+    '#! /bin/bash',
+    '#!/usr/bin/env bash',
+    '#! /usr/bin/env bash',
+    '#!/bin/sh',
+    '#! /bin/sh',
+    '#!/usr/bin/env sh',
+    '#! /usr/bin/env sh'
+]
+
+
 def shell_check_shebang(filename, header_lines):
 
     # Need to have at least one line for the rest of the checks to fail.
     while len(header_lines) < 1:
         header_lines.append('')
 
-    shebang_lines = [
-        '#!/bin/bash',
-        '#! /bin/bash',
-        '#!/usr/bin/env bash',
-        '#! /usr/bin/env bash',
-        '#!/bin/sh',
-        '#! /bin/sh',
-        '#!/usr/bin/env sh',
-        '#! /usr/bin/env sh'
-    ]
-    for shebang_line in shebang_lines:
+    for shebang_line in SHELL_SHEBANG_LINES:
         if header_lines[0].startswith(shebang_line):
             return []
 
     return report_file_error(
         'Incorrect shebang (#!) line',
         filename, 1,
-        shebang_lines[0], header_lines[0],
+        SHELL_SHEBANG_LINES[0], header_lines[0],
+        rule='shell-shebang',
     )
 
 
+PYTHON_SHEBANG_LINE = '#!/usr/bin/env python3'
+
+
 def python_check_shebang(filename, header_lines):
     r"""Checks using correct python3 shebang line.
 
@@ -188,17 +381,21 @@ def python_check_shebang(filename, header_lines):
     while len(header_lines) < 1:
         header_lines.append('')
 
-    shebang_line = '#!/usr/bin/env python3\n'
+    shebang_line = PYTHON_SHEBANG_LINE + '\n'
     if header_lines[0] != shebang_line:
         return report_file_error(
             'Incorrect shebang (#!) line',
             filename, 1,
             shebang_line, header_lines[0],
+            rule='python-shebang',
         )
 
     return []
 
 
+PYTHON_CODING_REGEX = '^#.*coding: utf-8.*$'
+
+
 def python_check_coding(filename, header_lines):
     r"""Check utf-8 encoding line appears in header.
 
@@ -230,51 +427,47 @@ def python_check_coding(filename, header_lines):
     while len(header_lines) < 2:
         header_lines.append('')
 
-    coding_line = '^#.*coding: utf-8.*$'
+    coding_line = PYTHON_CODING_REGEX
     if not re.match(coding_line, header_lines[1]):
         return report_file_error(
             'utf-8 coding not set',
             filename, 2,
             coding_line, header_lines[1],
+            rule='python-coding',
         )
 
     return []
 
 
-def shell_checks(pname):
+def shell_checks(ctx):
     """Checks shell scripts are valid.
 
     Checks performed:
      * Has the correct shebang (`#!`) starting the file.
     """
-    assert isinstance(pname, pathlib.Path), (pname, type(pname))
-    assert pname.is_file(), (pname, pname.stat())
+    assert isinstance(ctx, FileContext), (ctx, type(ctx))
+    pname = ctx.path
 
     fdebug(pname, 'Running shell checks.')
-    data = read_header(pname)
+    data = ctx.header_lines
 
     errors = []
     errors += shell_check_shebang(pname, data)
     return errors
 
 
-def python_checks(pname):
+def python_checks(ctx):
     """Checks python files are valid.
 
     Checks performed:
      * Has the correct shebang (`#!`) starting the file.
      * Has the utf-8 coding line at start of the file.
     """
-    assert isinstance(pname, pathlib.Path), (pname, type(pname))
-    assert pname.is_file(), (pname, pname.stat())
-
-    pattern = exclude_match(pname, 'python')
-    if pattern:
-        finfo(pname, 'Skipping python checks as matches %r.', pattern)
-        return []
+    assert isinstance(ctx, FileContext), (ctx, type(ctx))
+    pname = ctx.path
 
     fdebug(pname, 'Running python checks.')
-    data = read_header(pname)
+    data = ctx.header_lines
 
     errors = []
     errors += python_check_shebang(pname, data)
@@ -318,33 +511,286 @@ def license_check_spdx(filename, header_lines):
     if found_spdx:
         return []
 
-    return report_file_error(f'Missing {spdx_id} line in header', filename)
+    return report_file_error(
+        f'Missing {spdx_id} line in header', filename, rule='license-spdx')
 
 
-def license_checks(pname):
-    """Checks licensing in files is valid.
+# Regular expressions matching the start of a comment line, for each comment
+# style. Inside block comments, lines may start with nothing (or ` *`).
+COMMENT_STYLES = {
+    '#': r'#+',
+    '//': r'//+',
+    '--': r'--+',
+    '*': r'\*+',
+    '/*': r'(?:/\*+|\*(?!/))?',
+    '<!--': r'(?:<!--)?',
+}
+
+
+def license_header_checks_enabled(_cache=[]):
+    """Should the copyright line and license notice be checked?"""
+    if not _cache:
+        _cache.append(
+            os.environ.get('INPUT_LICENSE_HEADER', 'false').lower() in ('1', 'true'))
+    return _cache[0]
 
-    Checks performed:
-     * Check a `SPDX-License-Identifier` is found in the header.
 
-    TODO: Checks to be added:
-     * Check the copyright line.
-     * Check the license header
+def load_spdx_list(fname, _cache={}):
+    """Load a list of SPDX identifiers bundled with the checks."""
+    if fname not in _cache:
+        with open(__path__ / fname) as f:
+            _cache[fname] = frozenset(
+                l.strip() for l in f if l.strip() and not l.startswith('#'))
+    return _cache[fname]
 
+
+def spdx_expression_errors(expression):
+    """Check a SPDX license expression is valid.
+
+    Returns a list of the problems found with the expression.
+
+    >>> spdx_expression_errors('Apache-2.0')
+    []
+    >>> spdx_expression_errors('(MIT OR GPL-2.0-or-later) AND LicenseRef-Mine')
+    []
+    >>> spdx_expression_errors('GPL-2.0-only WITH LLVM-exception')
+    []
+    >>> spdx_expression_errors('Apache-2')
+    ["Unknown license 'Apache-2'"]
+    >>> spdx_expression_errors('MIT WITH Apache-2.0')
+    ["Unknown license exception 'Apache-2.0'"]
+    >>> spdx_expression_errors('MIT OR')
+    ['Invalid license expression']
     """
-    assert isinstance(pname, pathlib.Path), (pname, type(pname))
-    assert pname.is_file(), (pname, pname.stat())
+    licenses = load_spdx_list('spdx_licenses.txt')
+    exceptions = load_spdx_list('spdx_exceptions.txt')
 
-    pattern = exclude_match(pname, 'license')
-    if pattern:
-        finfo(pname, 'Skipping license checks as matches %r.', pattern)
+    errors = []
+    tokens = re.findall(r'[()]|[^\s()]+', expression)
+    # Alternating license (or parenthesised expression) and operator.
+    expect_license = True
+    depth = 0
+    previous = None
+    for token in tokens:
+        if token == '(' and expect_license:
+            depth += 1
+        elif token == ')' and not expect_license and depth:
+            depth -= 1
+        elif expect_license and token not in ('AND', 'OR', 'WITH', '(', ')'):
+            if previous == 'WITH':
+                if token not in exceptions:
+                    errors.append(f'Unknown license exception {token!r}')
+            elif not (token.rstrip('+') in licenses
+                      or token.startswith(('LicenseRef-', 'DocumentRef-'))):
+                errors.append(f'Unknown license {token!r}')
+            expect_license = False
+        elif not expect_license and token in ('AND', 'OR', 'WITH'):
+            if token == 'WITH' and previous in (')', 'WITH'):
+                return ['Invalid license expression']
+            expect_license = True
+        else:
+            return ['Invalid license expression']
+        previous = token
+    if expect_license or depth:
+        return ['Invalid license expression']
+    return errors
+
+
+# Years of a copyright line, for example `2020`, `2020-2022` or
+# `2018, 2020-2022`.
+COPYRIGHT_YEARS = r'\d{4}(?:[ \t]*-[ \t]*\d{4})?(?:[ \t]*,[ \t]*\d{4}(?:[ \t]*-[ \t]*\d{4})?)*'
+
+
+def copyright_years_errors(years, this_year=None):
+    """Check the years of a copyright line.
+
+    >>> copyright_years_errors('2020-2022', 2022)
+    []
+    >>> copyright_years_errors('2018, 2020 - 2021', 2022)
+    []
+    >>> copyright_years_errors('2022-2020', 2022)
+    ['Copyright year range 2022-2020 ends before it starts']
+    >>> copyright_years_errors('2023', 2022)
+    ['Copyright year 2023 is in the future']
+    """
+    if this_year is None:
+        this_year = time.localtime().tm_year
+    errors = []
+    for part in years.split(','):
+        ends = [int(y) for y in part.split('-')]
+        for year in ends:
+            if year < 1970:
+                errors.append(f'Copyright year {year} is too far in the past')
+            elif year > this_year:
+                errors.append(f'Copyright year {year} is in the future')
+        if len(ends) == 2 and ends[0] > ends[1]:
+            errors.append('Copyright year range {}-{} ends before it starts'.format(*ends))
+    return errors
+
+
+class HeaderTemplate:
+    """The license notice expected in the header of files.
+
+    The template is compiled into a regular expression once for each comment
+    style. The notice may be wrapped differently and the words may be
+    separated by any white space, but the words must be the same.
+
+    >>> t = HeaderTemplate('Example', 'Use it at  your own risk, see https://example.com')
+    >>> bool(t.search('// Use it at your\\n//   own risk, see\\n// http://example.com\\n', '//'))
+    True
+    >>> bool(t.search('# Use it at your own\\n# risk\\n', '#'))
+    False
+    """
+
+    def __init__(self, spdx_id, text):
+        self.spdx_id = spdx_id
+        self.words = text.split()
+        self._matchers = {}
+
+    @staticmethod
+    def word_regex(word):
+        regex = re.escape(word)
+        # Allow both for URLs.
+        return regex.replace('https://', 'https?://').replace('http://', 'https?://')
+
+    def matcher(self, style):
+        if style not in self._matchers:
+            prefix = COMMENT_STYLES[style]
+            sep = r'(?:[ \t]+|[ \t]*(?:\n[ \t]*{}[ \t]*)+)'.format(prefix)
+            self._matchers[style] = re.compile(
+                sep.join(self.word_regex(w) for w in self.words))
+        return self._matchers[style]
+
+    def search(self, text, style):
+        return self.matcher(style).search(text)
+
+
+# The license notices checked for, by the SPDX identifier of the license.
+LICENSE_HEADER_TEMPLATES = {t.spdx_id: t for t in [
+    HeaderTemplate('Apache-2.0', """
+        Licensed under the Apache License, Version 2.0 (the "License");
+        you may not use this file except in compliance with the License.
+        You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+        Unless required by applicable law or agreed to in writing, software
+        distributed under the License is distributed on an "AS IS" BASIS,
+        WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+        See the License for the specific language governing permissions and
+        limitations under the License.
+    """),
+]}
+
+
+def copyright_regex(style, _cache={}):
+    """Compiled regular expression matching a copyright line."""
+    if style not in _cache:
+        _cache[style] = re.compile(
+            r'^[ \t]*{}[ \t]*Copyright[ \t]+(?:(?:\(c\)|©)[ \t]+)?'
+            r'(?P<years>{})[ \t,]+(?P<holder>\S.*?)[ \t]*$'.format(
+                COMMENT_STYLES[style], COPYRIGHT_YEARS),
+            re.MULTILINE | re.IGNORECASE)
+    return _cache[style]
+
+
+def line_number(text, index):
+    return text.count('\n', 0, index) + 1
+
+
+def license_check_header(filename, header_lines, comments=('#',)):
+    r"""Check the SPDX identifier, copyright line and license notice.
+
+    >>> P = pathlib.Path
+    >>> header = '''\
+    ... // Copyright (C) 2020-2022 F4PGA Authors
+    ... //
+    ... // Licensed under the Apache License, Version 2.0 (the "License");
+    ... // you may not use this file except in compliance with the License.
+    ... // You may obtain a copy of the License at
+    ... //
+    ... //     http://www.apache.org/licenses/LICENSE-2.0
+    ... //
+    ... // Unless required by applicable law or agreed to in writing, software
+    ... // distributed under the License is distributed on an "AS IS" BASIS,
+    ... // WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    ... // See the License for the specific language governing permissions and
+    ... // limitations under the License.
+    ... //
+    ... // SPDX-License-Identifier: Apache-2.0
+    ... '''.splitlines(True)
+    >>> license_check_header(P('a.v'), header, comments=('//', '/*'))
+    []
+
+    The same header in a block comment.
+    >>> block = ['/*\n'] + [' *' + l[2:] for l in header] + [' */\n']
+    >>> license_check_header(P('a.v'), block, comments=('//', '/*'))
+    []
+
+    >>> license_check_header(P('a.v'), header[2:], comments=('//',))
+    ['Missing copyright line in header']
+    >>> license_check_header(P('a.v'), header[:6] + header[7:], comments=('//',))
+    ['License header does not match the Apache-2.0 license notice']
+    >>> license_check_header(P('a.py'), ['# SPDX-License-Identifier: Apache-2\n'])
+    ["Unknown license 'Apache-2'", 'Missing copyright line in header']
+    """
+    # Skip empty '__init__.py' files
+    if filename.match('__init__.py') and not header_lines:
         return []
 
+    text = ''.join(header_lines)
+    errors = []
+
+    spdx = re.search(
+        r'SPDX-License-Identifier:[ \t]*(?P<expr>.*?)[ \t]*(?:\*/|-->)?[ \t]*$',
+        text, re.MULTILINE)
+    if spdx:
+        lineno = line_number(text, spdx.start())
+        for e in spdx_expression_errors(spdx.group('expr')):
+            errors += report_file_error(e, filename, lineno, rule='license-spdx-invalid')
+
+    for style in comments:
+        copyright = copyright_regex(style).search(text)
+        if copyright:
+            break
+    if copyright:
+        fdebug(filename, 'Found copyright line %r', copyright.group(0))
+        lineno = line_number(text, copyright.start())
+        for e in copyright_years_errors(copyright.group('years')):
+            errors += report_file_error(e, filename, lineno, rule='license-copyright')
+    else:
+        errors += report_file_error(
+            'Missing copyright line in header', filename, rule='license-copyright')
+
+    template = spdx and LICENSE_HEADER_TEMPLATES.get(spdx.group('expr'))
+    if template and not any(template.search(text, style) for style in comments):
+        errors += report_file_error(
+            f'License header does not match the {template.spdx_id} license notice',
+            filename, rule='license-header')
+
+    return errors
+
+
+def license_checks(ctx):
+    """Checks licensing in files is valid.
+
+    Checks performed:
+     * Check a `SPDX-License-Identifier` is found in the header.
+     * When `license_header_checks_enabled()`, check the SPDX license
+       expression, the copyright line and the license notice.
+
+    """
+    assert isinstance(ctx, FileContext), (ctx, type(ctx))
+    pname = ctx.path
+
     fdebug(pname, 'Running license checks.')
-    data = read_header(pname)
+    data = ctx.header_lines
 
     errors = []
     errors += license_check_spdx(pname, data)
+    if license_header_checks_enabled():
+        comments = ctx.ftype.comments if ctx.ftype is not None else ('#',)
+        errors += license_check_header(pname, data, comments)
     return errors
 
 
@@ -363,12 +809,199 @@ LICENSE_FILES_EXTENSIONS = [
     '-MIT',
 ]
 
+# Lower case names of the license files, so a directory entry can be checked
+# with a single lookup.
+LICENSE_FILE_NAMES = frozenset(
+    (lname + lext).lower()
+    for lname in LICENSE_FILES
+    for lext in LICENSE_FILES_EXTENSIONS)
+
+# Number of bytes at the start of a license file used to identify it.
+LICENSE_READ_SIZE = 1024*16
+
+
+def normalize_license_text(text):
+    r"""Normalize license text for matching against `LICENSE_FINGERPRINTS`.
+
+    Case, punctuation, comment characters and line wrapping are all ignored.
+
+    >>> normalize_license_text('# Apache License,\n#   Version 2.0')
+    'apache license version 2 0'
+    """
+    return ' '.join(re.findall('[a-z0-9]+', text.lower()))
+
+
+# Phrases which all appear in the normalized text of each license. They are
+# tried in order, so licenses which contain the phrases of another license
+# (the BSD-3-Clause contains the BSD-2-Clause) come first. The GNU licenses
+# all refer to each other, so they are matched by their full title.
+LICENSE_FINGERPRINTS = [
+    (spdx_id, [normalize_license_text(p) for p in phrases])
+    for spdx_id, phrases in [
+        ('Apache-2.0', ['Apache License', 'Version 2.0']),
+        ('MPL-2.0', ['Mozilla Public License Version 2.0']),
+        ('AGPL-3.0', ['GNU Affero General Public License Version 3, 19 November 2007']),
+        ('LGPL-2.0', ['GNU Library General Public License Version 2, June 1991']),
+        ('LGPL-2.1', ['GNU Lesser General Public License Version 2.1, February 1999']),
+        ('LGPL-3.0', ['GNU Lesser General Public License Version 3, 29 June 2007']),
+        ('GPL-2.0', ['GNU General Public License Version 2, June 1991']),
+        ('GPL-3.0', ['GNU General Public License Version 3, 29 June 2007']),
+        ('BSD-3-Clause', [
+            'Redistribution and use in source and binary forms',
+            'Neither the name of']),
+        ('BSD-2-Clause', ['Redistribution and use in source and binary forms']),
+        ('MIT', [
+            'Permission is hereby granted, free of charge, to any person obtaining a copy',
+            'The above copyright notice and this permission notice shall be included']),
+        ('ISC', ['Permission to use, copy, modify, and/or distribute this software for any purpose']),
+        ('BSL-1.0', ['Boost Software License - Version 1.0']),
+        ('Unlicense', ['This is free and unencumbered software released into the public domain']),
+        ('CC0-1.0', ['CC0 1.0 Universal']),
+    ]
+]
+
+
+def identify_license(text):
+    """Identify the license from the text of a license file.
+
+    Returns the SPDX identifier (or the SPDX license expression given by a
+    valid `SPDX-License-Identifier` line), or `None` when the license is not
+    known.
+
+    >>> identify_license('SPDX-License-Identifier: ISC')
+    'ISC'
+    >>> identify_license('// SPDX-License-Identifier: MIT OR Apache-2.0')
+    'MIT OR Apache-2.0'
+    >>> identify_license('SPDX-License-Identifier: Apache-2') is None
+    True
+    >>> identify_license('''
+    ...                   GNU LIBRARY GENERAL PUBLIC LICENSE
+    ...                        Version 2, June 1991
+    ...
+    ...  This license, the Library General Public License, applies to some
+    ... specially designated Free Software Foundation software, and to any
+    ... other libraries whose authors decide to use it. You can use it for
+    ... your libraries, too. Most GNU software is covered by the ordinary GNU
+    ... General Public License.
+    ... ''')
+    'LGPL-2.0'
+    >>> identify_license('Permission is hereby granted, free of charge, to any '
+    ...                  'person obtaining a copy of this software. The above '
+    ...                  'copyright notice and this permission notice shall be '
+    ...                  'included in all copies.')
+    'MIT'
+    >>> identify_license('All rights reserved.') is None
+    True
+    """
+    m = re.search(
+        r'SPDX-License-Identifier:[ \t]*(?P<expr>.*?)[ \t]*(?:\*/|-->)?[ \t]*$',
+        text, re.MULTILINE)
+    if m and not spdx_expression_errors(m.group('expr')):
+        return m.group('expr')
+
+    text = normalize_license_text(text)
+    for spdx_id, phrases in LICENSE_FINGERPRINTS:
+        if all(p in text for p in phrases):
+            return spdx_id
+    return None
+
 
-def third_party_checks(pname):
+# License identified for each license file, by the hash of its contents.
+# Vendored code often includes identical license files, and the `ResultCache`
+# keeps them between runs.
+_license_ids = {}
+
+
+def license_file_id(lpath):
+    """Identify the license of a license file, cached by its contents.
+
+    Only the first `LICENSE_READ_SIZE` bytes of the file are used.
+
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> lpath = pathlib.Path(tmp.name) / 'COPYING'
+    >>> _ = lpath.write_text(
+    ...     'GNU GENERAL PUBLIC LICENSE\\nVersion 3, 29 June 2007\\n'
+    ...     + 'x\\n' * LICENSE_READ_SIZE
+    ...     + 'Use with the GNU Affero General Public License Version 3, 19 November 2007\\n')
+    >>> lpath.stat().st_size > LICENSE_READ_SIZE
+    True
+    >>> license_file_id(lpath)
+    'GPL-3.0'
+    >>> tmp.cleanup()
+    """
+    with open(lpath, 'rb') as f:
+        data = f.read(LICENSE_READ_SIZE)
+    key = hashlib.sha256(data).hexdigest()
+    if key not in _license_ids:
+        _license_ids[key] = identify_license(data.decode('utf-8', errors='replace'))
+    return _license_ids[key]
+
+
+def allowed_licenses(_cache=[]):
+    """The licenses third party directories may use, empty to allow any."""
+    if not _cache:
+        raw = os.environ.get('INPUT_ALLOWED_LICENSES', '')
+        logging.debug('INPUT_ALLOWED_LICENSES = %r', raw)
+        _cache.append(frozenset(raw.split()))
+    return _cache[0]
+
+
+def license_expression_allowed(expression, allowed):
+    """Do the `allowed` licenses satisfy a (valid) SPDX license expression?
+
+    A license exception (`WITH`) only gives more permissions, so it is
+    ignored.
+
+    >>> license_expression_allowed('MIT', {'MIT'})
+    True
+    >>> license_expression_allowed('MIT OR GPL-2.0 AND BSD-3-Clause', {'GPL-2.0'})
+    False
+    >>> license_expression_allowed('(MIT OR GPL-2.0) AND BSD-3-Clause', {'MIT', 'BSD-3-Clause'})
+    True
+    >>> license_expression_allowed('GPL-2.0-only WITH LLVM-exception', {'GPL-2.0-only'})
+    True
+    """
+    tokens = re.findall(r'[()]|[^\s()]+', expression)
+
+    def parse_or(i):
+        value, i = parse_and(i)
+        while i < len(tokens) and tokens[i] == 'OR':
+            other, i = parse_and(i + 1)
+            value = value or other
+        return value, i
+
+    def parse_and(i):
+        value, i = parse_license(i)
+        while i < len(tokens) and tokens[i] == 'AND':
+            other, i = parse_license(i + 1)
+            value = value and other
+        return value, i
+
+    def parse_license(i):
+        if tokens[i] == '(':
+            value, i = parse_or(i + 1)
+            # Skip the closing parenthesis.
+            return value, i + 1
+        value = tokens[i] in allowed
+        i += 1
+        if i < len(tokens) and tokens[i] == 'WITH':
+            i += 2
+        return value, i
+
+    return parse_or(0)[0]
+
+
+def third_party_checks(pname, project=False):
     """Check a directory containing third party contents.
 
+    Each directory in `pname` is a third party project, or when `project` is
+    set `pname` itself is.
+
     Checks performed:
      * Checks there is a LICENSE file in each directory.
+     * When `allowed_licenses()` are given, checks the license identified
+       from the LICENSE files is one of them (or that a license expression
+       is satisfied by them).
 
     """
     assert isinstance(pname, pathlib.Path), (pname, type(pname))
@@ -376,81 +1009,800 @@ def third_party_checks(pname):
 
     fdebug(pname, 'Running third_party directory checks.')
 
+    allowed = allowed_licenses()
     errors = {}
-    for dpath in pname.glob('*'):
+    for dpath in ([pname] if project else pname.glob('*')):
         if not dpath.is_dir():
             continue
 
-        license_files = []
-        for fname in os.listdir(dpath):
-            for lname in LICENSE_FILES:
-                for lext in LICENSE_FILES_EXTENSIONS:
-                    lname_ext = lname + lext
-
-                    if str(lname_ext).lower() == str(fname).lower():
-                        lpath = dpath / fname
-                        license_files.append(lpath)
+        license_files = [
+            dpath / fname
+            for fname in os.listdir(dpath)
+            if fname.lower() in LICENSE_FILE_NAMES
+        ]
 
         if not license_files:
             reldpath = relpath(dpath)
 
             errors[dpath] = report_error(
                 '%s: A license file was not found (tried %s)' % (
-                    reldpath, LICENSE_FILES))
+                    reldpath, LICENSE_FILES),
+                rule='third-party-license', filename=dpath)
+            continue
 
         for l in license_files:
             fdebug(dpath, 'Found LICENSE file %s', l)
 
+        if not allowed:
+            continue
+
+        license_ids = set()
+        for l in license_files:
+            try:
+                license_id = license_file_id(l)
+            except OSError as e:
+                fwarn(l, 'Unable to read license file: %s', e)
+                continue
+            fdebug(dpath, 'License file %s is %s', l.name, license_id)
+            if license_id is not None:
+                license_ids.add(license_id)
+
+        if not license_ids:
+            errors[dpath] = report_error(
+                '%s: Unable to identify the license from %s' % (
+                    relpath(dpath), sorted(l.name for l in license_files)),
+                rule='third-party-license-unknown', filename=dpath)
+        elif not any(license_expression_allowed(l, allowed) for l in license_ids):
+            errors[dpath] = report_error(
+                '%s: License %s is not one of the allowed licenses (%s)' % (
+                    relpath(dpath), ', '.join(sorted(license_ids)),
+                    ', '.join(sorted(allowed))),
+                rule='third-party-license-not-allowed', filename=dpath)
+
     return errors
 
 
+# Modules loaded from plugin files, by path.
+_plugin_modules = {}
+
+
+def load_plugin(fpath, name):
+    """Load the function `name` from the Python file `fpath`.
+
+    Plugins can use the functions of this script (like `report_file_error`)
+    with `import checks`.
+    """
+    module = _plugin_modules.get(fpath)
+    if module is None:
+        # When running as a script, make `import checks` find this module
+        # rather than loading a second copy.
+        sys.modules.setdefault('checks', sys.modules[__name__])
+        logging.debug('Loading checks plugin %s', fpath)
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(
+            'f4pga_checks_plugin_{}'.format(len(_plugin_modules)), fpath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _plugin_modules[fpath] = module
+    return getattr(module, name)
+
+
+class Checker:
+    """A check run on the header of the files of some types.
+
+    `function` is called with the `FileContext` of each file and returns a
+    list of errors. For a plugin it is the path of a Python file and the
+    name of the function in it instead, the file is only imported when the
+    first file is checked.
+
+    The settings decide how the checker is run;
+     * `file_types` - names of the `FileType`s it is run on, `None` for all.
+     * `header_size` - characters at the start of the file it looks at. The
+       largest needed by the checkers of a file type is read.
+     * `exclude` - files matching the exclude patterns of this type (see
+       `excludes`) are skipped.
+     * `parallel` - can it run in the worker processes? Otherwise it is run
+       in the main process and its results aren't cached.
+     * `enabled` - disabled checkers are never run or imported.
+    """
+
+    SETTINGS = {
+        'file_types': list,
+        'header_size': int,
+        'exclude': str,
+        'parallel': bool,
+        'enabled': bool,
+    }
+
+    def __init__(self, name, function, file_types=None, header_size=HEADER_SIZE,
+                 exclude=None, parallel=True, enabled=True):
+        self.name = name
+        self.plugin = None if callable(function) else function
+        self._function = function if callable(function) else None
+        self.file_types = file_types
+        self.header_size = header_size
+        self.exclude = exclude
+        self.parallel = parallel
+        self.enabled = enabled
+
+    def __repr__(self):
+        return 'Checker({!r})'.format(self.name)
+
+    @property
+    def function(self):
+        if self._function is None:
+            self._function = load_plugin(*self.plugin)
+        return self._function
+
+    def applies_to(self, ftype):
+        return self.enabled and (self.file_types is None or ftype.name in self.file_types)
+
+    def version(self):
+        """The settings and plugin code the results depend on."""
+        settings = [(s, getattr(self, s)) for s in self.SETTINGS]
+        if self.plugin is not None:
+            with open(self.plugin[0], 'rb') as f:
+                settings.append(('plugin', hashlib.sha256(f.read()).hexdigest()))
+        return repr((self.name, settings))
+
+    def __call__(self, ctx):
+        if self.exclude is not None:
+            pattern = exclude_match(ctx.path, self.exclude, is_dir=False)
+            if pattern:
+                finfo(ctx.path, 'Skipping %s checks as matches %r.', self.name, pattern)
+                return []
+        return self.function(ctx)
+
+
+# Registered checkers by name, in the order they are run.
+CHECKERS = {}
+
+
+def register_checker(name, function, **settings):
+    """Register a check to run on files, see `Checker` for the `settings`.
+
+    >>> register_checker('example', lambda ctx: [], file_types=['Yaml'])
+    Checker('example')
+    >>> FILE_TYPES['Yaml'].checkers
+    [Checker('license'), Checker('example')]
+    >>> unregister_checker('example')
+    >>> FILE_TYPES['Yaml'].checkers
+    [Checker('license')]
+    """
+    assert name not in CHECKERS, (name, CHECKERS[name])
+    checker = Checker(name, function, **settings)
+    CHECKERS[name] = checker
+    checkers_changed()
+    return checker
+
+
+def unregister_checker(name):
+    del CHECKERS[name]
+    checkers_changed()
+
+
+def checkers_changed():
+    """Find the checkers of each file type again."""
+    for ftype in FILE_TYPES.values():
+        ftype._checkers = None
+
+
+class FileType:
+    """A type of file and the checks which are run on it."""
+
+    def __init__(self, name, comments=('#',)):
+        self.name = name
+        self.comments = tuple(comments)
+        self._checkers = None
+
+    def __repr__(self):
+        return 'FileType({!r})'.format(self.name)
+
+    @property
+    def checkers(self):
+        """The enabled `Checker`s run on this type of file."""
+        if self._checkers is None:
+            self._checkers = [c for c in CHECKERS.values() if c.applies_to(self)]
+        return self._checkers
+
+    @property
+    def header_size(self):
+        """The number of characters at the start of the file needed."""
+        return max((c.header_size for c in self.checkers), default=HEADER_SIZE)
+
+
+# Registered file types by name, see `register_file_type`.
+FILE_TYPES = {}
+
+# Registered file types by exact file name and by file extension (the part of
+# the name starting at the last `.`).
+FILE_TYPES_BY_FILENAME = {}
+FILE_TYPES_BY_SUFFIX = {}
+
+
+def register_file_type(name, suffixes=(), filenames=(), comments=('#',)):
+    """Register a type of file to be checked.
+
+    Files are detected as `name` when their name is one of `filenames` or
+    ends with one of `suffixes`. The `Checker`s for the type are run on them
+    (see `register_checker`). The license header is looked for in comments
+    of the `comments` styles (see `COMMENT_STYLES`).
+
+    >>> register_file_type('Example', suffixes=['.example'])
+    FileType('Example')
+    >>> detect_file_type(pathlib.Path('a/b.example'))
+    'Example'
+    >>> FILE_TYPES['Example'].checkers
+    [Checker('license')]
+    >>> unregister_file_type('Example')
+    >>> detect_file_type(pathlib.Path('a/b.example')) is None
+    True
+    """
+    assert name not in FILE_TYPES, (name, FILE_TYPES[name])
+    ftype = FileType(name, comments)
+    for suffix in suffixes:
+        assert suffix.startswith('.'), suffix
+        assert suffix not in FILE_TYPES_BY_SUFFIX, (suffix, FILE_TYPES_BY_SUFFIX[suffix])
+        FILE_TYPES_BY_SUFFIX[suffix] = ftype
+    for filename in filenames:
+        assert filename not in FILE_TYPES_BY_FILENAME, (filename, FILE_TYPES_BY_FILENAME[filename])
+        FILE_TYPES_BY_FILENAME[filename] = ftype
+    FILE_TYPES[name] = ftype
+    return ftype
+
+
+def unregister_file_type(name):
+    ftype = FILE_TYPES.pop(name)
+    for registry in (FILE_TYPES_BY_SUFFIX, FILE_TYPES_BY_FILENAME):
+        for k, v in list(registry.items()):
+            if v is ftype:
+                del registry[k]
+
+
+register_checker('license', license_checks, exclude='license')
+register_checker('python', python_checks, file_types=['Python'], exclude='python')
+register_checker('shell', shell_checks, file_types=['Shell'])
+
+# Configuration file read from the root of the repository.
+CONFIG_FILE = '.f4pga-checks.toml'
+
+
+def load_config(fpath):
+    """Read the TOML configuration file `fpath`, `{}` when there is none."""
+    try:
+        f = open(fpath, 'rb')
+    except FileNotFoundError:
+        logging.debug('No configuration file %s', fpath)
+        return {}
+    with f:
+        try:
+            import tomllib
+        except ImportError:
+            # Before Python 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ValueError('reading it needs Python 3.11 or the tomli package') from None
+        return tomllib.load(f)
+
+
+def configure_checkers(config, base_dir, plugins=False):
+    """Apply the `checkers` tables of the configuration.
+
+    The settings of the registered checkers are changed and the other tables
+    register plugins, the `path` of the plugin file is relative to
+    `base_dir` and the `function` defaults to `check`. Plugins run code from
+    the repository, so they are skipped unless `plugins` is set.
+
+    >>> configure_checkers({'checkers': {'python': {'enabled': False}}}, pathlib.Path())
+    >>> FILE_TYPES['Python'].checkers
+    [Checker('license')]
+    >>> configure_checkers({'checkers': {'python': {'enabled': True}}}, pathlib.Path())
+    >>> FILE_TYPES['Python'].checkers
+    [Checker('license'), Checker('python')]
+    >>> configure_checkers({'checkers': {'python': {'parallel': 'no'}}}, pathlib.Path())
+    Traceback (most recent call last):
+     ...
+    ValueError: checkers.python.parallel should be a bool, not 'no'
+    >>> configure_checkers({'checkers': {'new': {}}}, pathlib.Path())
+    Traceback (most recent call last):
+     ...
+    ValueError: checkers.new needs the path of the plugin file
+    >>> configure_checkers({'checkers': {'new': {'path': 'new.py'}}}, pathlib.Path())
+    >>> 'new' in CHECKERS
+    False
+    """
+    for name, table in config.get('checkers', {}).items():
+        settings = dict(table)
+        plugin = None
+        if name not in CHECKERS:
+            if 'path' not in settings:
+                raise ValueError('checkers.{} needs the path of the plugin file'.format(name))
+            plugin = (base_dir / settings.pop('path'), settings.pop('function', 'check'))
+
+        for key, value in settings.items():
+            if key not in Checker.SETTINGS:
+                raise ValueError('Unknown setting checkers.{}.{}'.format(name, key))
+            if not isinstance(value, Checker.SETTINGS[key]):
+                raise ValueError('checkers.{}.{} should be a {}, not {!r}'.format(
+                    name, key, Checker.SETTINGS[key].__name__, value))
+        for ftype in settings.get('file_types', ()):
+            if ftype not in FILE_TYPES:
+                logging.warning('Unknown file type %r for checker %r', ftype, name)
+
+        if plugin is not None:
+            if not plugins:
+                logging.warning(
+                    'Not adding checker %r from %s as plugins are not enabled',
+                    name, plugin[0])
+                continue
+            register_checker(name, plugin, **settings)
+            continue
+        for key, value in settings.items():
+            setattr(CHECKERS[name], key, value)
+        checkers_changed()
+
+
+# The arguments of the last `load_checkers_config` call. The worker processes
+# load the configuration again unless they were forked after it was loaded.
+_checkers_config = None
+
+
+def load_checkers_config(fpath, base_dir, plugins=False):
+    """Apply the configuration file `fpath` with `configure_checkers`."""
+    global _checkers_config
+    configure_checkers(load_config(fpath), base_dir, plugins)
+    _checkers_config = (fpath, base_dir, plugins)
+
+
+# Scripting files
+register_file_type('Python', suffixes=['.py'])
+register_file_type('Shell', suffixes=['.sh'])
+
+# Configuration files
+register_file_type('Yaml', suffixes=['.yaml', '.yml'])
+register_file_type('XML', suffixes=['.xml'], comments=['<!--'])
+register_file_type('Make', suffixes=['.mk'], filenames=['Makefile'])
+
+# Hardware files
+register_file_type('Verilog', suffixes=['.v'], comments=['//', '/*'])
+register_file_type('SystemVerilog', suffixes=['.sv'], comments=['//', '/*'])
+register_file_type('Spice', suffixes=['.spice'], comments=['*'])
+register_file_type('Circuit Description Language', suffixes=['.cdl'], comments=['*'])
+register_file_type('Library Exchange Format', suffixes=['.lef', '.def'])
+
+
+def lookup_file_type(name):
+    """Find the registered `FileType` for a file name.
+
+    >>> lookup_file_type('checks.py')
+    FileType('Python')
+    >>> lookup_file_type('Makefile')
+    FileType('Make')
+    >>> lookup_file_type('a.b.yml')
+    FileType('Yaml')
+    >>> lookup_file_type('README') is None
+    True
+    """
+    ftype = FILE_TYPES_BY_FILENAME.get(name)
+    if ftype is not None:
+        return ftype
+    i = name.rfind('.')
+    if i == -1:
+        return None
+    return FILE_TYPES_BY_SUFFIX.get(name[i:])
+
+
 def detect_file_type(pname):
-    if not pname.is_file():
+    """Detect the type of a file from its name and `linguist-language`.
+
+    >>> detect_file_type(pathlib.Path('/a/b/c.sv'))
+    'SystemVerilog'
+    >>> detect_file_type(pathlib.Path('/a/b/c.txt')) is None
+    True
+    """
+    ftype = file_type(pname)
+    if ftype is None:
         return None
+    return ftype.name
+
 
-    # Scripting files
-    if pname.match('*.py'):
-        return 'Python'
+def glob_part_to_regex(part):
+    r"""Convert a glob for a single path component into a regex.
 
-    if pname.match('*.sh'):
-        return 'Shell'
+    Follows `fnmatch` but wildcards never match a `/`.
 
-    # Configuration files
-    if pname.match('*.yaml') or pname.match('*.yml'):
-        return 'Yaml'
+    >>> glob_part_to_regex('*.py')
+    '[^/]*\\.py'
+    >>> glob_part_to_regex('[!a]?')
+    '(?!/)[^a][^/]'
+    >>> glob_part_to_regex('[abc')
+    '\\[abc'
+    """
+    i, n = 0, len(part)
+    res = []
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            if not res or res[-1] != '[^/]*':
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and part[j] == '!':
+                j += 1
+            if j < n and part[j] == ']':
+                j += 1
+            while j < n and part[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+                continue
+            stuff = part[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if stuff[0] == '!':
+                stuff = '^' + stuff[1:]
+            elif stuff[0] in ('^', '['):
+                stuff = '\\' + stuff
+            res.append('(?!/)[{}]'.format(stuff))
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
 
-    if pname.match('*.xml'):
-        return 'XML'
 
-    if pname.match('Makefile') or pname.match('*.mk'):
-        return 'Make'
+def glob_to_regex(pattern):
+    r"""Convert a `pathlib.PurePath.match` pattern into a regex.
 
-    # Hardware files
-    if pname.match('*.v'):
-        return 'Verilog'
+    Like `PurePath.match`, relative patterns match the end of the path while
+    absolute patterns must match the whole path.
 
-    if pname.match('*.sv'):
-        return 'SystemVerilog'
+    >>> glob_to_regex('*/third_party')
+    '(?:^|/)[^/]*/third_party$'
+    >>> glob_to_regex('/abc/*.py')
+    '^/abc/[^/]*\\.py$'
+    """
+    parts = pathlib.PurePosixPath(pattern).parts
+    if not parts:
+        raise ValueError('empty pattern')
+    if parts[0] == '/':
+        return '^/' + '/'.join(glob_part_to_regex(p) for p in parts[1:]) + '$'
+    return '(?:^|/)' + '/'.join(glob_part_to_regex(p) for p in parts) + '$'
+
+
+class ExcludeMatcher:
+    r"""Matches string paths against a list of exclude patterns.
+
+    The patterns are combined into a single regex so a path which matches
+    none of the patterns (the common case) only needs one regex search. Gives
+    the same results as calling `pathlib.PurePath.match` for each pattern.
+
+    >>> m = ExcludeMatcher(['*/third_party', '*/third_party/*', '.git'])
+    >>> m.match('/src/third_party')
+    '*/third_party'
+    >>> m.match('/src/third_party/abc')
+    '*/third_party/*'
+    >>> m.match('/src/.git')
+    '.git'
+    >>> m.match('/src/.github') is None
+    True
+    >>> ExcludeMatcher([]).match('/src') is None
+    True
+
+    Check the results match `PurePath.match` (the previous implementation).
+
+    >>> patterns = [
+    ...     '.git', '*env', 'build', '*cache*', '*/*/__init__.py',
+    ...     './miniconda.sh', '*/.*', '*/__pycache__/*', '*/.pytest_*/*',
+    ...     'tests', '*/tests/*', '*/tests', '*/python/*', '*/python',
+    ...     'third_party', 'third_party/*', '*/third_party/*',
+    ...     '/src/*', '/src/a/*', '*.py', 'a?c', '[ab]*', '[!a]*/b',
+    ...     '*/[a-c]', 'a/b/c/d/e/f', '**/b', 'a*b*c', '[', '[]]', '*[*',
+    ... ]
+    >>> paths = [
+    ...     '/src', '/src/.git', '/src/.github', '/src/venv', '/src/env',
+    ...     '/src/build', '/src/build/x.py', '/src/a/build', '/src/__pycache__',
+    ...     '/src/a/__pycache__/b.pyc', '/src/pkg/__init__.py',
+    ...     '/src/a/pkg/__init__.py', '/src/miniconda.sh', '/src/a/.hidden',
+    ...     '/src/.pytest_cache/x', '/src/tests', '/src/a/tests',
+    ...     '/src/a/tests/b', '/src/a/python/b.py', '/src/python',
+    ...     '/src/third_party', '/src/third_party/x', '/src/a/third_party/x/y',
+    ...     '/src/abc', '/src/a/b', '/src/b/b', '/src/a/c', '/src/a/d',
+    ...     '/src/a/b/c/d/e/f', '/src/axbxc', '/src/[', '/src/]', '/src/a[b',
+    ...     '/src/x.py', '/src/a/x.py', '/src/x.pyc',
+    ... ]
+    >>> for pattern in patterns:
+    ...     regex = re.compile(glob_to_regex(pattern))
+    ...     for path in paths:
+    ...         old = pathlib.PurePosixPath(path).match(pattern)
+    ...         new = regex.search(path) is not None
+    ...         if old != new:
+    ...             print(pattern, path, old, new)
+    """
 
-    if pname.match('*.spice'):
-        return 'Spice'
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.regexes = [re.compile(glob_to_regex(p)) for p in self.patterns]
+        if self.patterns:
+            self.combined = re.compile('|'.join(
+                '(?:{})'.format(r.pattern) for r in self.regexes))
+        else:
+            self.combined = None
 
-    if pname.match('*.cdl'):
-        return 'Circuit Description Language'
+    def match(self, path):
+        """Return the first pattern matching `path` or `None`."""
+        if self.combined is None or self.combined.search(path) is None:
+            return None
+        for pattern, regex in zip(self.patterns, self.regexes):
+            if regex.search(path) is not None:
+                return pattern
+        raise AssertionError((path, self.patterns))
 
-    if pname.match('*.lef') or pname.match('*.def'):
-        return 'Library Exchange Format'
 
-    return None
+def exclude_matcher(exclude_type, dirs, _cache={}):
+    key = (exclude_type, dirs)
+    if key not in _cache:
+        _cache[key] = ExcludeMatcher(excludes(exclude_type, dirs=dirs))
+    return _cache[key]
 
 
-def exclude_match(path, exclude_type):
-    for pattern in excludes(exclude_type, dirs=path.is_dir()):
-        if not path.match(pattern):
-            fdebug(path, "Doesn't match %r for %s", pattern, exclude_type)
+def exclude_match(path, exclude_type, is_dir=None):
+    """Return the first exclude pattern of `exclude_type` matching `path`.
+
+    `is_dir` can be given when the caller already knows if `path` is a
+    directory, to save checking the file system.
+    """
+    if is_dir is None:
+        is_dir = os.path.isdir(path)
+    with profile_phase('exclude matching'):
+        pattern = exclude_matcher(exclude_type, is_dir).match(str(path))
+    if pattern:
+        fdebug(path, "Matches %r for %s", pattern, exclude_type)
+    return pattern
+
+
+def gitattributes_pattern_to_regex(pattern):
+    r"""Convert a `.gitattributes` pattern into a regex.
+
+    The regex matches paths relative to the directory of the `.gitattributes`
+    file. Patterns without a `/` match the file name at any depth. A trailing
+    `/**` also matches the directory itself, so directories can be marked.
+    A trailing `/` is dropped, `parse_gitattributes` only matches these
+    patterns against directories.
+
+    >>> r = re.compile(gitattributes_pattern_to_regex('*.v'))
+    >>> bool(r.match('a.v')), bool(r.match('b/a.v')), bool(r.match('a.vh'))
+    (True, True, False)
+    >>> r = re.compile(gitattributes_pattern_to_regex('/vendor/**'))
+    >>> bool(r.match('vendor')), bool(r.match('vendor/a/b')), bool(r.match('a/vendor/b'))
+    (True, True, False)
+    >>> r = re.compile(gitattributes_pattern_to_regex('**/gen/*.py'))
+    >>> bool(r.match('gen/a.py')), bool(r.match('x/y/gen/a.py')), bool(r.match('gen/a/b.py'))
+    (True, True, False)
+    """
+    anchored = '/' in pattern.rstrip('/')
+    parts = pattern.strip('/').split('/')
+    res = '' if anchored else '(?:.*/)?'
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == '**':
+            if last and res.endswith('/'):
+                # Remove the `/` before so the directory itself matches.
+                res = res[:-1] + '(?:/.*)?'
+            elif last:
+                res = '.*'
+            else:
+                res += '(?:.*/)?'
         else:
-            fdebug(path, "Matches %r for %s", pattern, exclude_type)
-            return pattern
+            res += glob_part_to_regex(part) + ('' if last else '/')
+    return res + '$'
+
+
+def parse_gitattributes(text):
+    """Parse the lines of a `.gitattributes` file.
+
+    Returns a list of the compiled pattern, the attributes set and if the
+    pattern only matches directories (it ends with `/`) for each line.
+    Attributes are `True` when set, `False` when unset, `None` when
+    unspecified or their value.
+
+    >>> [(r.pattern, a, d) for r, a, d in parse_gitattributes('''
+    ... # Comment
+    ... *.v  linguist-language=SystemVerilog -diff !text
+    ... vendor/ linguist-vendored
+    ... ''')]
+    [('(?:.*/)?[^/]*\\\\.v$', {'linguist-language': 'SystemVerilog', 'diff': False, 'text': None}, False), ('(?:.*/)?vendor$', {'linguist-vendored': True}, True)]
+    """
+    rules = []
+    for line in text.splitlines():
+        fields = line.split()
+        # Quoted patterns and macros aren't supported.
+        if not fields or fields[0].startswith(('#', '"', '[attr]')):
+            continue
+        attrs = {}
+        for field in fields[1:]:
+            if field.startswith('-'):
+                attrs[field[1:]] = False
+            elif field.startswith('!'):
+                attrs[field[1:]] = None
+            elif '=' in field:
+                name, value = field.split('=', 1)
+                attrs[name] = value
+            else:
+                attrs[field] = True
+        if attrs:
+            rules.append((
+                re.compile(gitattributes_pattern_to_regex(fields[0])), attrs,
+                fields[0].endswith('/')))
+    return rules
+
+
+class GitAttributes:
+    """The attributes given to paths under `root_dir` by `.gitattributes` files.
+
+    Each `.gitattributes` file is read and compiled once, the first time a
+    path in its directory is looked up. Like git, the attributes from deeper
+    files override those from the files above them and `.git/info/attributes`
+    overrides them all.
+    """
+
+    FILENAME = '.gitattributes'
+
+    def __init__(self, root_dir):
+        self.root_dir = pathlib.Path(root_dir)
+        self._prefix = os.path.join(str(self.root_dir), '')
+        self._rules = {}
+        self._info_rules = self.read(self.root_dir / '.git' / 'info' / 'attributes')
+
+    @staticmethod
+    def read(fpath):
+        try:
+            with open(fpath, encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return []
+        logging.debug('Loading attributes from %s', fpath)
+        return parse_gitattributes(text)
+
+    def rules(self, dname):
+        """The rules of the `.gitattributes` file in the directory `dname`."""
+        if dname not in self._rules:
+            self._rules[dname] = self.read(self.root_dir / dname / self.FILENAME)
+        return self._rules[dname]
+
+    def lookup(self, path, is_dir=False):
+        """The attributes of `path`, as a dictionary.
+
+        Like git, patterns ending with `/` only match when `is_dir` is set.
+
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> root = pathlib.Path(tmp.name)
+        >>> (root / 'a').mkdir()
+        >>> _ = (root / '.gitattributes').write_text('*.v linguist-generated\\nb/ linguist-vendored\\n')
+        >>> _ = (root / 'a' / '.gitattributes').write_text('x.v -linguist-generated\\n')
+        >>> attrs = GitAttributes(root)
+        >>> attrs.lookup(root / 'a' / 'y.v'), attrs.lookup(root / 'a' / 'x.v')
+        ({'linguist-generated': True}, {'linguist-generated': False})
+        >>> attrs.lookup(root / 'a', is_dir=True)
+        {}
+        >>> attrs.lookup(root / 'a' / 'b', is_dir=True), attrs.lookup(root / 'a' / 'b')
+        ({'linguist-vendored': True}, {})
+        >>> tmp.cleanup()
+        """
+        # Plain string operations, as this is called for every file.
+        path = str(path)
+        if not path.startswith(self._prefix):
+            return {}
+        rpath = path[len(self._prefix):].replace(os.sep, '/')
+
+        # The `.gitattributes` files which apply, from the top down, with the
+        # path relative to each.
+        sources = []
+        start = 0
+        while True:
+            rules = self.rules(rpath[:max(start - 1, 0)])
+            if rules:
+                sources.append((rules, rpath[start:]))
+            i = rpath.find('/', start)
+            if i == -1:
+                break
+            start = i + 1
+        if self._info_rules:
+            sources.append((self._info_rules, rpath))
+        if not sources:
+            return {}
+
+        attrs = {}
+        with profile_phase('gitattributes'):
+            for rules, relative in sources:
+                for regex, line_attrs, dir_only in rules:
+                    if (is_dir or not dir_only) and regex.match(relative):
+                        attrs.update(line_attrs)
+        return attrs
+
+
+_gitattributes = None
+
+
+def gitattributes():
+    """The `GitAttributes` of the current directory."""
+    global _gitattributes
+    if _gitattributes is None:
+        _gitattributes = GitAttributes(pathlib.Path().resolve())
+    return _gitattributes
+
+
+def is_generated(path, is_dir=False):
+    """Is `path` marked as `linguist-generated`?"""
+    return gitattributes().lookup(path, is_dir).get('linguist-generated') is True
+
+
+def is_skipped_file(fpath):
+    """Is the file `fpath` marked as `linguist-generated` or `linguist-vendored`?
+
+    Vendored files are third party contents like vendored directories, but
+    they have no directory to hold a license file so they are only skipped.
+
+    >>> import unittest.mock
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> root = pathlib.Path(tmp.name)
+    >>> _ = (root / '.gitattributes').write_text('x.py linguist-vendored\\n')
+    >>> with unittest.mock.patch(__name__ + '._gitattributes', GitAttributes(root)):
+    ...     is_skipped_file(root / 'x.py'), is_skipped_file(root / 'y.py')
+    (True, False)
+    >>> tmp.cleanup()
+    """
+    attrs = gitattributes().lookup(fpath)
+    if attrs.get('linguist-generated') is True:
+        finfo(fpath, 'Skipping file as marked linguist-generated')
+        return True
+    if attrs.get('linguist-vendored') is True:
+        finfo(fpath, 'Skipping file as marked linguist-vendored')
+        return True
+    return False
+
+
+def third_party_kind(dpath):
+    """How the directory `dpath` is treated as third party contents.
+
+    Returns `'directory'` when `dpath` matches the `third_party` patterns (the
+    directory contains third party projects), `'project'` when `dpath` is
+    marked as `linguist-vendored` (the directory is a third party project) or
+    `None`.
+    """
+    pattern = exclude_match(dpath, 'third_party', is_dir=True)
+    if pattern:
+        finfo(dpath, 'Considering third party as matches %r', pattern)
+        return 'directory'
+    if gitattributes().lookup(dpath, is_dir=True).get('linguist-vendored') is True:
+        finfo(dpath, 'Considering third party as marked linguist-vendored')
+        return 'project'
+    return None
+
+
+# Linguist language names which aren't the name of the file type.
+LINGUIST_LANGUAGES = {
+    'yaml': 'Yaml',
+    'makefile': 'Make',
+}
+
+
+def file_type(fpath):
+    """Find the `FileType` of a file.
+
+    The `linguist-language` attribute of the file overrides the type found
+    from its name. Files with a language which isn't registered are not
+    checked.
+    """
+    language = gitattributes().lookup(fpath).get('linguist-language')
+    if not isinstance(language, str):
+        return lookup_file_type(fpath.name)
+    name = LINGUIST_LANGUAGES.get(language.lower(), language).lower()
+    for ftype in FILE_TYPES.values():
+        if ftype.name.lower() == name:
+            return ftype
+    fdebug(fpath, 'Unknown linguist-language %r', language)
     return None
 
 
@@ -473,144 +1825,1769 @@ class OutputGroup:
         print()
 
 
-def main(args):
-    root_dir = pathlib.Path().resolve()
-    logging.debug('Starting search in: %s', root_dir)
+class Profile:
+    """Timing and counts collected while running the checks.
 
-    errors = {}
-    for root, dirs, files in os.walk(root_dir):
-        rpath = pathlib.Path(root).resolve()
+    Each process collects its own `Profile` (in `_profile`), the ones from the
+    worker processes are merged into the main one.
+    """
+
+    # Number of slowest files / directories to keep.
+    SLOWEST = 20
+
+    def __init__(self):
+        self.phases = collections.Counter()
+        self.phase_calls = collections.Counter()
+        self.files = 0
+        self.type_files = collections.Counter()
+        self.type_times = collections.Counter()
+        self.dir_files = collections.Counter()
+        self.dir_times = collections.Counter()
+        # Heap of (seconds, path) for the slowest files.
+        self.slowest_files = []
+
+    def add_phase(self, name, seconds):
+        self.phases[name] += seconds
+        self.phase_calls[name] += 1
+
+    def add_file(self, path, ftype, seconds):
+        self.files += 1
+        self.type_files[ftype] += 1
+        self.type_times[ftype] += seconds
+        dname = str(path.parent)
+        self.dir_files[dname] += 1
+        self.dir_times[dname] += seconds
+        item = (seconds, str(path))
+        if len(self.slowest_files) < self.SLOWEST:
+            heapq.heappush(self.slowest_files, item)
+        else:
+            heapq.heappushpop(self.slowest_files, item)
+
+    def merge(self, other):
+        self.phases.update(other.phases)
+        self.phase_calls.update(other.phase_calls)
+        self.files += other.files
+        self.type_files.update(other.type_files)
+        self.type_times.update(other.type_times)
+        self.dir_files.update(other.dir_files)
+        self.dir_times.update(other.dir_times)
+        for item in other.slowest_files:
+            if len(self.slowest_files) < self.SLOWEST:
+                heapq.heappush(self.slowest_files, item)
+            else:
+                heapq.heappushpop(self.slowest_files, item)
+
+    def to_json(self, wall_time):
+        def rel(p):
+            return os.path.relpath(p)
+
+        return {
+            'wall_time': wall_time,
+            'files': self.files,
+            'files_per_second': self.files / wall_time if wall_time else None,
+            'phases': {
+                name: {'seconds': t, 'calls': self.phase_calls[name]}
+                for name, t in sorted(self.phases.items())
+            },
+            'file_types': {
+                ftype: {'files': n, 'seconds': self.type_times[ftype]}
+                for ftype, n in sorted(self.type_files.items())
+            },
+            'directories': {
+                rel(d): {'files': n, 'seconds': self.dir_times[d]}
+                for d, n in sorted(self.dir_files.items())
+            },
+            'slowest_files': [
+                {'path': rel(p), 'seconds': t}
+                for t, p in sorted(self.slowest_files, reverse=True)
+            ],
+        }
+
+    def print_summary(self, wall_time, top=10):
+        with OutputGroup('Profile'):
+            rate = self.files / wall_time if wall_time else 0.0
+            print('Checked {} files in {:.3f}s ({:.1f} files/s)'.format(
+                self.files, wall_time, rate))
+            print()
+            print('Time per phase (summed over all jobs, the checks include')
+            print('reading the headers and matching excludes):')
+            for name, t in self.phases.most_common():
+                print('  {:<40} {:>10.3f}s {:>10} calls'.format(
+                    name, t, self.phase_calls[name]))
+            print()
+            print('Files per type:')
+            for ftype, n in self.type_files.most_common():
+                print('  {:<40} {:>10} files {:>10.3f}s'.format(
+                    ftype, n, self.type_times[ftype]))
+            print()
+            print('Slowest directories:')
+            for d, t in self.dir_times.most_common(top):
+                print('  {:<40} {:>10} files {:>10.3f}s'.format(
+                    os.path.relpath(d), self.dir_files[d], t))
+            print()
+            print('Slowest files:')
+            for t, p in sorted(self.slowest_files, reverse=True)[:top]:
+                print('  {:<40} {:>10.6f}s'.format(os.path.relpath(p), t))
+
+
+# The `Profile` collecting timing in this process, `None` unless profiling.
+_profile = None
+
+
+class _ProfilePhase:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _profile.add_phase(self.name, time.perf_counter() - self.start)
+
+
+_NO_PROFILE_PHASE = contextlib.nullcontext()
+
+
+def profile_phase(name):
+    """Context timing a phase of the checks when profiling is enabled."""
+    if _profile is None:
+        return _NO_PROFILE_PHASE
+    return _ProfilePhase(name)
+
+
+def check_file(fpath):
+    """Run all the checks which apply to a single file.
+
+    Returns the list of errors found in the file.
+    """
+    ftype = file_type(fpath)
+    if ftype is None:
+        finfo(fpath, 'Skipping unknown file type')
+        return []
+    if not ftype.checkers:
+        fdebug(fpath, 'Skipping file as no checks are enabled for %s', ftype.name)
+        return []
+
+    return run_file_checks(FileContext(fpath, ftype))
+
+
+def serial_check_file(fpath):
+    """Run the checkers which can't run in parallel on a single file.
+
+    Returns the `Finding`s.
+    """
+    with recording_findings() as findings:
+        ftype = file_type(fpath)
+        if ftype is not None and not all(c.parallel for c in ftype.checkers):
+            run_file_checks(FileContext(fpath, ftype), serial=True)
+    return findings
+
+
+def run_file_checks(ctx, serial=False):
+    """Run the checkers for the type of file `ctx` is.
+
+    Only the checkers which can run in parallel are run, or when `serial` is
+    set only the others.
+
+    Binary files are skipped and problems reading or decoding the file are
+    reported as errors in the file.
+    """
+    checkers = [c for c in ctx.ftype.checkers if c.parallel != serial]
+    if serial and not checkers:
+        return []
+
+    try:
+        if ctx.is_binary:
+            finfo(ctx.path, 'Skipping binary file')
+            return []
+    except OSError as e:
+        return report_file_error(
+            'Unable to read file: {}'.format(e.strerror or e), ctx.path,
+            rule='file-unreadable')
+
+    ferrors = []
+    if not serial:
+        ferrors += header_check_encoding(ctx)
+    for checker in checkers:
+        with profile_phase('check ' + checker.name):
+            ferrors += checker(ctx)
+    return ferrors
+
+
+def header_check_encoding(ctx):
+    """Check the header of the file is valid utf-8.
+
+    The checks still run on the header with the invalid bytes replaced.
+    """
+    if '\ufffd' not in ''.join(ctx.header_lines):
+        return []
+
+    invalid = find_invalid_utf8(ctx.header_bytes)
+    if invalid is None:
+        # The file really contains U+FFFD.
+        return []
+
+    lineno, data = invalid
+    return report_file_error(
+        'Invalid utf-8 in header (found {!r})'.format(data), ctx.path, lineno,
+        rule='header-encoding')
+
+
+class FixOptions(collections.namedtuple('FixOptions', 'write spdx_license')):
+    """How problems are fixed.
+
+    When `write` is false, the fixes are only output as a patch. The
+    `spdx_license` is the license expression added to files without a
+    SPDX-License-Identifier line, these are not fixed when it is `None`.
+    """
+
+
+def fix_python_shebang(lines, ftype, options):
+    """
+    >>> fix_python_shebang(['#!/usr/bin/python', 'x'], None, None)
+    ['#!/usr/bin/env python3', 'x']
+    >>> fix_python_shebang(['x'], None, None)
+    ['#!/usr/bin/env python3', 'x']
+    """
+    if lines[0] == PYTHON_SHEBANG_LINE:
+        return lines
+    if lines[0].startswith('#!'):
+        lines = lines[1:]
+    return [PYTHON_SHEBANG_LINE] + lines
+
+
+def fix_python_coding(lines, ftype, options):
+    """
+    >>> fix_python_coding(['#!/usr/bin/env python3', '# coding: latin-1'], None, None)
+    ['#!/usr/bin/env python3', '# -*- coding: utf-8 -*-']
+    >>> fix_python_coding(['#!/usr/bin/env python3', 'x'], None, None)
+    ['#!/usr/bin/env python3', '# -*- coding: utf-8 -*-', 'x']
+    """
+    if len(lines) > 1 and re.match(PYTHON_CODING_REGEX, lines[1]):
+        return lines
+    if len(lines) > 1 and re.match(r'^#.*coding[:=]', lines[1]):
+        lines = lines[:1] + lines[2:]
+    return lines[:1] + ['# -*- coding: utf-8 -*-'] + lines[1:]
+
+
+def fix_shell_shebang(lines, ftype, options):
+    """
+    >>> fix_shell_shebang(['#!/bin/zsh', 'x'], None, None)
+    ['#!/bin/bash', 'x']
+    >>> fix_shell_shebang(['#!/bin/sh', 'x'], None, None)
+    ['#!/bin/sh', 'x']
+    """
+    if any(lines[0].startswith(l) for l in SHELL_SHEBANG_LINES):
+        return lines
+    if lines[0].startswith('#!'):
+        lines = lines[1:]
+    return [SHELL_SHEBANG_LINES[0]] + lines
+
+
+# Format of a SPDX-License-Identifier line for comment styles which need more
+# than the comment characters at the start of the line.
+SPDX_LINE_FORMATS = {
+    '/*': '/* {} */',
+    '<!--': '<!-- {} -->',
+}
+
+
+def fix_license_spdx(lines, ftype, options):
+    """
+    >>> options = FixOptions(True, 'Apache-2.0')
+    >>> fix_license_spdx(['#!/bin/bash', 'x'], FILE_TYPES['Shell'], options)
+    ['#!/bin/bash', '# SPDX-License-Identifier: Apache-2.0', 'x']
+    >>> fix_license_spdx(['<?xml version="1.0"?>', '<a/>'], FILE_TYPES['XML'], options)
+    ['<?xml version="1.0"?>', '<!-- SPDX-License-Identifier: Apache-2.0 -->', '<a/>']
+    """
+    if options.spdx_license is None:
+        return lines
+
+    # Keep the lines which have to come first.
+    index = 0
+    if lines[0].startswith(('#!', '<?xml')):
+        index += 1
+    if index < len(lines) and re.match(r'^#.*coding[:=]', lines[index]):
+        index += 1
+
+    style = ftype.comments[0]
+    line = SPDX_LINE_FORMATS.get(style, style + ' {}').format(
+        'SPDX-License-Identifier: ' + options.spdx_license)
+    return lines[:index] + [line] + lines[index:]
+
+
+# The functions fixing the problems reported by each rule, in the order they
+# are applied.
+FIXERS = {
+    'python-shebang': fix_python_shebang,
+    'shell-shebang': fix_shell_shebang,
+    'python-coding': fix_python_coding,
+    'license-spdx': fix_license_spdx,
+}
+
+
+def write_file_atomic(fpath, data):
+    """Replace the contents of a file, keeping its permissions.
+
+    The new contents are written to a temporary file which is renamed over
+    the file, so the file is never left half written. When `fpath` is a
+    symlink the file it points to is replaced, so the link is kept.
+
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> target = pathlib.Path(tmp.name) / 'a.sh'
+    >>> _ = target.write_text('old')
+    >>> target.chmod(0o755)
+    >>> link = pathlib.Path(tmp.name) / 'b.sh'
+    >>> link.symlink_to(target.name)
+    >>> write_file_atomic(link, b'new')
+    >>> link.is_symlink(), target.read_text(), oct(stat.S_IMODE(target.stat().st_mode))
+    (True, 'new', '0o755')
+    >>> tmp.cleanup()
+    """
+    fpath = pathlib.Path(os.path.realpath(fpath))
+    mode = stat.S_IMODE(os.stat(fpath).st_mode)
+    with tempfile.NamedTemporaryFile(
+            'wb', dir=fpath.parent, prefix=f'.{fpath.name}.', delete=False) as f:
+        f.write(data)
+    try:
+        os.chmod(f.name, mode)
+        os.replace(f.name, fpath)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+
+def patch_lines(text):
+    r"""Split text into lines for `difflib.unified_diff`.
+
+    >>> patch_lines('a\nb\n')
+    ['a\n', 'b\n']
+    >>> patch_lines('a\nb')
+    ['a\n', 'b\n\\ No newline at end of file\n']
+    """
+    lines = [l + '\n' for l in text.split('\n')]
+    if lines[-1] == '\n':
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1] + '\n\\ No newline at end of file\n'
+    return lines
+
+
+def fix_file(fpath, rules, options):
+    """Fix the problems reported by `rules` in a file.
+
+    Returns the fixes as a unified diff, or `None` when nothing was fixed.
+    The file is only changed when `options.write` is set.
+    """
+    ftype = file_type(fpath)
+    fixers = [f for rule, f in FIXERS.items() if rule in rules]
+    if ftype is None or not fixers:
+        return None
+
+    with profile_phase('fix'):
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            fwarn(fpath, 'Not fixing file as it is not valid utf-8.')
+            return None
+
+        first_line = text.split('\n', 1)[0]
+        newline = '\r\n' if first_line.endswith('\r') else '\n'
+        old_lines = text.split(newline)
+        new_lines = old_lines
+        for fixer in fixers:
+            new_lines = fixer(new_lines, ftype, options)
+        if new_lines == old_lines:
+            return None
+
+        if options.write:
+            write_file_atomic(fpath, newline.join(new_lines).encode('utf-8'))
+            finfo(fpath, 'Fixed %s', ', '.join(sorted(rules & FIXERS.keys())))
+
+        import difflib
+        name = pathlib.PurePath(relpath(fpath)).as_posix()
+        return ''.join(difflib.unified_diff(
+            patch_lines(newline.join(old_lines)), patch_lines(newline.join(new_lines)),
+            'a/' + name, 'b/' + name))
+
+
+class ResultCache:
+    """On-disk cache of the errors found in each file.
+
+    The checks only look at the header of a file (the first
+    `FileType.header_size` characters), so the errors found only depend on the
+    path, the header contents, the checks themselves and the exclude
+    configuration. The results of checkers which don't run in parallel are
+    never cached. The cached errors for
+    a file are reused when:
+
+     * the file size and modification time are unchanged (no need to read the
+       file at all), or
+     * the hash of the header is unchanged (for example after a fresh checkout
+       in CI with a restored cache directory).
+
+    The entries of the files not checked by a run over the whole tree (like
+    deleted or renamed files) are dropped.
+
+    The licenses identified from the third party license files are also
+    kept, by the hash of their contents.
+
+    The whole cache is discarded when the checks (the contents of this
+    script) or the exclude configuration change.
+
+    >>> import unittest.mock
+    >>> def clear_excludes():
+    ...     excludes.__defaults__[-1].clear()
+    ...     exclude_matcher.__defaults__[-1].clear()
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> root = pathlib.Path(tmp.name)
+    >>> for name in ('sub/tests/a.py', 'third_party/x/a.py'):
+    ...     (root / name).parent.mkdir(parents=True, exist_ok=True)
+    ...     _ = (root / name).write_text('x = 1\\n')
+    >>> env = {'INPUT_EXCLUDE_DIRECTORY': '.git */tests/*', 'INPUT_THIRD_PARTY': '*/third_party/*'}
+    >>> with unittest.mock.patch.dict(os.environ, env):
+    ...     clear_excludes()
+    ...     results = run_checks(root, 1, cache=ResultCache(root / '.cache'))
+    >>> clear_excludes()
+    >>> [os.path.relpath(path, relpath(root)) for path, _ in results.sorted_errors()]
+    ['third_party/x']
+    >>> results.close()
+    >>> tmp.cleanup()
+    """
+
+    FILENAME = 'f4pga-checks-cache.json'
+
+    def __init__(self, cache_dir):
+        self.path = pathlib.Path(cache_dir) / self.FILENAME
+        self.version = self.checks_version()
+        self.entries = {}
+        # The paths checked in this run.
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def checks_version():
+        """Hash of the checks code, its data and the configuration."""
+        h = hashlib.sha256()
+        for fpath in (__file__, __path__ / 'spdx_licenses.txt', __path__ / 'spdx_exceptions.txt'):
+            with open(fpath, 'rb') as f:
+                h.update(f.read())
+        etypes = {'directory', 'third_party'}
+        etypes.update(c.exclude for c in CHECKERS.values() if c.exclude)
+        for etype in sorted(etypes):
+            env_name = excludes_env_name(etype)
+            h.update(repr((env_name, os.environ.get(env_name, ''))).encode('utf-8'))
+        for checker in CHECKERS.values():
+            if checker.enabled and checker.parallel:
+                h.update(checker.version().encode('utf-8'))
+        h.update(repr(('license_header', license_header_checks_enabled())).encode('utf-8'))
+        return h.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logging.info('No result cache found at %s', self.path)
+            return
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable result cache %s: %s', self.path, e)
+            return
+
+        if data.get('version') != self.version:
+            logging.info('Ignoring result cache %s from different checks.', self.path)
+            return
+
+        self.entries = data['entries']
+        _license_ids.update(data.get('licenses', {}))
+        logging.debug('Loaded %s entries from %s', len(self.entries), self.path)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so an interrupted run doesn't leave
+        # a broken cache behind.
+        with tempfile.NamedTemporaryFile(
+                'w', dir=self.path.parent, delete=False) as f:
+            json.dump({
+                'version': self.version,
+                'entries': self.entries,
+                'licenses': _license_ids,
+            }, f)
+        os.replace(f.name, self.path)
+        logging.debug('Saved %s entries to %s', len(self.entries), self.path)
+
+    def update(self, key, entry, hit):
+        self.seen.add(key)
+        if hit is None:
+            return
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if entry is not None:
+            self.entries[key] = entry
+
+    def drop_unseen(self):
+        """Drop the entries of the paths not checked in this run.
+
+        After checking the whole tree, these are the files which were
+        deleted, renamed or excluded.
+
+        >>> cache = ResultCache('.')
+        >>> cache.entries = {'a.py': {}, 'b.py': {}}
+        >>> cache.update('a.py', None, True)
+        >>> cache.drop_unseen()
+        >>> cache.entries
+        {'a.py': {}}
+        """
+        for key in self.entries.keys() - self.seen:
+            del self.entries[key]
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0.0
+        print('Result cache: {} hits, {} misses ({:.1f}% hit rate)'.format(
+            self.hits, self.misses, rate))
+
+
+def cached_check_file(fpath, entries):
+    """Run `check_file` reusing the errors from the `ResultCache` entries.
+
+    Must be called while `recording_findings`.
+
+    Returns a tuple of the errors, the new cache entry (`None` when the entry
+    is unchanged) and if the cache was hit (`None` when the file isn't
+    checked).
+    """
+    ftype = file_type(fpath)
+    if ftype is None:
+        finfo(fpath, 'Skipping unknown file type')
+        return [], None, None
+    if not ftype.checkers:
+        fdebug(fpath, 'Skipping file as no checks are enabled for %s', ftype.name)
+        return [], None, None
+    ctx = FileContext(fpath, ftype)
+
+    key = str(fpath)
+    st = fpath.stat()
+    entry = entries.get(key)
+    if entry is not None and entry.get('type') != ftype.name:
+        entry = None
+    if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+        new_entry = None
+    else:
+        digest = hashlib.sha256(ctx.header_bytes).hexdigest()
+        if entry is not None and entry['hash'] != digest:
+            entry = None
+        new_entry = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'hash': digest,
+            'type': ftype.name,
+        }
+
+    if entry is not None:
+        fdebug(fpath, 'Using cached results')
+        ferrors = []
+        for lineno, rule, error in entry['reports']:
+            ferrors += report_file_error(error, fpath, lineno, rule=rule)
+        if new_entry is not None:
+            new_entry['reports'] = entry['reports']
+        return ferrors, new_entry, True
+
+    with recording_findings() as findings:
+        ferrors = run_file_checks(ctx)
+    new_entry['reports'] = [(f.line, f.rule, f.message) for f in findings]
+    _recorded_findings.extend(findings)
+    return ferrors, new_entry, False
+
+
+# Entries of the `ResultCache` in the worker processes.
+_worker_cache_entries = None
+
+# The `FixOptions` when fixing the problems found.
+_worker_fix = None
+
+
+def check_files(fpaths):
+    """Run `check_file` on a batch of files.
+
+    Used as the unit of work when running with multiple jobs, batching the
+    files reduces the overhead of sending work to the worker processes.
+
+    When fixing, the problems found are fixed and the files checked again.
+
+    Returns a list of the path, `Finding`s, new `ResultCache` entry, cache
+    hit and the patch of the fixes made for each file, and the `Profile` of
+    the batch when profiling.
+    """
+    global _profile
+
+    def check(fpath):
+        if _worker_cache_entries is None:
+            return (check_file(fpath), None, None)
+        return cached_check_file(fpath, _worker_cache_entries)
+
+    results = []
+    for fpath in fpaths:
+        if _profile is not None:
+            start = time.perf_counter()
+        patch = None
+        with recording_findings() as findings:
+            result = check(fpath)
+            rules = {f.rule for f in findings}
+            if _worker_fix is not None and rules & FIXERS.keys():
+                try:
+                    patch = fix_file(fpath, rules, _worker_fix)
+                except OSError as e:
+                    fwarn(fpath, 'Unable to fix file: %s', e)
+                if patch and _worker_fix.write:
+                    findings.clear()
+                    result = check(fpath)
+        if _profile is not None:
+            ftype = lookup_file_type(fpath.name)
+            _profile.add_file(
+                fpath, ftype.name if ftype else 'Unknown',
+                time.perf_counter() - start)
+        _, cache_entry, cache_hit = result
+        results.append((fpath, findings, cache_entry, cache_hit, patch))
+    # Output from the workers is only flushed when the process exits otherwise.
+    sys.stdout.flush()
+
+    profile = None
+    if _profile is not None:
+        profile, _profile = _profile, Profile()
+    return results, profile
+
+
+class CheckResults:
+    """Collects the results of running the checks.
+
+    Each `Finding` is passed on to the reporters as soon as it is found. For
+    the error summary, the findings are sorted using bounded memory; once
+    `max_in_memory` findings have been collected they are sorted and spilled
+    to a temporary file, the files are merged when the summary is output.
+    The number of errors per rule and per directory are also counted.
+
+    The patches of the fixes made are written to the `patch` file.
+
+    >>> results = CheckResults(max_in_memory=2)
+    >>> results.report([Finding('a-b', 1, 'x', 'm1'), Finding('a/b', 2, 'x', 'm2')])
+    >>> results.report([Finding('a/a', 1, 'y', 'm3')])
+    >>> list(results.sorted_errors())
+    [('a/a', 'm3'), ('a/b', 'm2'), ('a-b', 'm1')]
+    >>> results.error_paths, dict(results.rule_counts)
+    (3, {'x': 2, 'y': 1})
+    >>> results.close()
+    """
+
+    def __init__(self, reporters=(), max_in_memory=10000, patch=None):
+        self.reporters = list(reporters)
+        self.max_in_memory = max_in_memory
+        self.patch = patch
+        self.fixed_paths = 0
+        self.error_paths = 0
+        self.rule_counts = collections.Counter()
+        self.dir_counts = collections.Counter()
+        self._buffer = []
+        self._runs = []
+
+    @staticmethod
+    def sort_key(path, message):
+        # Sort paths by their components (like `pathlib` does) so `a/b` comes
+        # before `a-b`.
+        return path.split('/'), message
+
+    def report(self, findings):
+        if not findings:
+            return
+        for reporter in self.reporters:
+            reporter.add(findings)
+
+        paths = set()
+        for finding in findings:
+            # Problems which aren't about a path are only output as they
+            # happen.
+            if finding.path is None:
+                continue
+            paths.add(finding.path)
+            self.rule_counts[finding.rule or 'error'] += 1
+            self.dir_counts[posixpath.dirname(finding.path) or '.'] += 1
+            self._buffer.append((finding.path, finding.message))
+        self.error_paths += len(paths)
+
+        if len(self._buffer) >= self.max_in_memory:
+            self._spill()
+
+    def add_fix(self, patch):
+        self.fixed_paths += 1
+        if self.patch is not None:
+            self.patch.write(patch)
+
+    def _spill(self):
+        self._buffer.sort(key=lambda i: self.sort_key(*i))
+        run = tempfile.TemporaryFile('w+', encoding='utf-8')
+        for item in self._buffer:
+            run.write(json.dumps(item))
+            run.write('\n')
+        run.seek(0)
+        self._runs.append(run)
+        self._buffer = []
+        logging.debug('Spilled errors to %s run files', len(self._runs))
+
+    @staticmethod
+    def _read_run(run):
+        for line in run:
+            yield tuple(json.loads(line))
+
+    def sorted_errors(self):
+        """Iterate over `(path, error)` for all the errors, in sorted order."""
+        self._buffer.sort(key=lambda i: self.sort_key(*i))
+        iterables = [self._read_run(run) for run in self._runs]
+        iterables.append(iter(self._buffer))
+        return heapq.merge(*iterables, key=lambda i: self.sort_key(*i))
+
+    def print_summary(self, limit, top=20):
+        """Output the error summary.
+
+        When more than `limit` paths have errors, only the number of errors
+        per rule and per directory is output rather than every error.
+        """
+        if not self.error_paths:
+            return
+
+        with OutputGroup('Error summary'):
+            if limit and self.error_paths > limit:
+                print('Found {} errors in {} paths, only showing the counts.'.format(
+                    sum(self.rule_counts.values()), self.error_paths))
+                print()
+                print('Errors by rule:')
+                for rule, n in self.rule_counts.most_common():
+                    print('  {:<40} {:>10}'.format(rule, n))
+                print()
+                print('Errors by directory (top {}):'.format(top))
+                for dname, n in self.dir_counts.most_common(top):
+                    print('  {:<40} {:>10}'.format(dname, n))
+                return
+
+            last_path = None
+            for path, error in self.sorted_errors():
+                if path != last_path:
+                    if last_path is not None:
+                        print()
+                    print()
+                    print(path)
+                    last_path = path
+                print(' *', error)
+            print()
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+
+def add_third_party_errors(rpath, results, kind='directory'):
+    with recording_findings() as findings:
+        third_party_checks(rpath, project=(kind == 'project'))
+    results.report(findings)
+
+
+def scan_dir(dpath):
+    """List the contents of `dpath` with `os.scandir`.
+
+    Uses the file type information returned with the directory listing, so
+    most entries don't need a separate `stat` call.
+
+    Returns sorted lists of the sub-directory names, the file names and the
+    names of anything else (broken symlinks, sockets, etc). Symlinks to
+    directories are not included, like `os.walk` they are not followed.
+    """
+    dirs = []
+    files = []
+    nonfiles = []
+    try:
+        with os.scandir(dpath) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+                    else:
+                        nonfiles.append(entry.name)
+                except OSError:
+                    nonfiles.append(entry.name)
+    except OSError as e:
+        fwarn(dpath, 'Unable to list directory: %s', e)
+
+    dirs.sort()
+    files.sort()
+    nonfiles.sort()
+    return dirs, files, nonfiles
+
+
+def walk_files(root_dir, results):
+    """Walk `root_dir` yielding the files which should be checked.
+
+    Directory level checks (like the third_party checks) are run during the
+    walk and their errors are added to the `CheckResults`.
+
+    `root_dir` must already be resolved, the paths found under it are only
+    joined to their parent directory.
+    """
+    # Directories still to be searched, in reverse order so the tree is
+    # searched depth first in sorted order.
+    to_search = [root_dir]
+    while to_search:
+        rpath = to_search.pop()
+        with profile_phase('walk'):
+            dirs, files, nonfiles = scan_dir(rpath)
         fdebug(rpath, 'Searching')
-        fdebug(rpath, 'dirs=%r files=%r', dirs, files)
+        fdebug(rpath, 'dirs=%r files=%r', dirs, files + nonfiles)
 
         # Treat the third_party directories special
-        # FIXME: Should probably support the `linguist-vendored` properties
-        #  https://github.com/github/linguist/blob/master/docs/overrides.md
-        pattern = exclude_match(rpath, 'third_party')
-        if pattern:
-            finfo(rpath, 'Considering third party as matches %r', pattern)
-            derrors = third_party_checks(rpath)
-            if derrors:
-                for k, v in derrors.items():
-                    assert k not in errors, (k, v, errors)
-                    errors[k] = v
+        kind = third_party_kind(rpath)
+        if kind:
+            add_third_party_errors(rpath, results, kind)
 
             # Don't enter further into the third_party directory.
-            dirs.clear()
             continue
 
-
         # Filter out
-        to_remove_dirs = []
+        subdirs = []
         for dname in dirs:
-            dpath = (rpath / dname).resolve()
-            assert dpath.is_dir(), (dname, dpath)
-            pattern = exclude_match(dpath, 'directory')
+            dpath = rpath / dname
+            pattern = exclude_match(dpath, 'directory', is_dir=True)
             if pattern:
                 finfo(dpath, 'Skipping directory as matches %r', pattern)
-                to_remove_dirs.append(dname)
-
-        for dname in to_remove_dirs:
-            dirs.remove(dname)
+                continue
+            if is_generated(dpath, is_dir=True):
+                finfo(dpath, 'Skipping directory as marked linguist-generated')
+                continue
+            subdirs.append(dpath)
+        to_search.extend(reversed(subdirs))
 
-        # Search the directories in sorted order
-        dirs.sort()
+        for fname in nonfiles:
+            fwarn(rpath / fname, 'Skipping nonfile')
 
         # Run the checks on files
-        # FIXME: Should probably use linguist for file type detection?
-        for fname in sorted(files):
-            fpath = (rpath / fname).resolve()
-            if not fpath.is_file():
-                fwarn(fpath, 'Skipping nonfile')
+        for fname in files:
+            fpath = rpath / fname
+            if is_skipped_file(fpath):
                 continue
+            yield fpath
 
-            ftype = detect_file_type(fpath)
-            if ftype is None:
-                finfo(fpath, 'Skipping unknown file type')
-                continue
 
-            ferrors = []
-            ferrors += license_checks(fpath)
+def git_command(*args):
+    # Inside the GitHub Actions docker container the workspace is owned by a
+    # different user, which makes newer versions of git refuse to run.
+    cmd = ['git', '-c', 'safe.directory=*'] + list(args)
+    logging.debug('Running %s', cmd)
+    return cmd
 
-            if ftype == 'Python':
-                ferrors += python_checks(fpath)
 
-            if ftype == 'Shell':
-                ferrors += shell_checks(fpath)
+def git(*args, **kw):
+    """Run a git command and return its output."""
+    return subprocess.run(
+        git_command(*args), check=True, stdout=subprocess.PIPE, **kw).stdout
 
-            if ferrors:
-                errors[fpath] = ferrors
 
-    if errors:
-        with OutputGroup('Error summary'):
-            for fpath in sorted(errors):
-                frelpath = fpath.relative_to(root_dir)
-                print()
-                print(frelpath)
-                for e in sorted(errors[fpath]):
-                    print(' *', e)
-                print()
+def git_tracked_files():
+    """Yield the paths of the files tracked by git, as git lists them.
+
+    The output of `git ls-files` is read in chunks rather than all at once.
+    Files in submodules are included. Git failing is only raised once all
+    the paths have been yielded.
+
+    Returns paths relative to the current working directory.
+    """
+    cmd = git_command('ls-files', '-z', '--recurse-submodules')
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        rest = b''
+        while True:
+            with profile_phase('git ls-files'):
+                chunk = proc.stdout.read(64*1024)
+            if not chunk:
+                break
+            paths = (rest + chunk).split(b'\0')
+            rest = paths.pop()
+            for p in paths:
+                yield os.fsdecode(p)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def dir_checker(root_dir):
+    """Make a function deciding if the files in a directory are checked.
+
+    Applies the same directory exclusion and third_party handling as
+    `walk_files` to a directory and its parents, for checking the files from
+    a list of paths. The function returns `None` if the files in the
+    directory should be checked, `True` if the directory is skipped or the
+    third_party directory which owns it and its `third_party_kind`.
+    """
+    # Decision for each directory seen so far.
+    dir_state = {}
+
+    def check_dir(dpath):
+        if dpath not in dir_state:
+            state = None
+            if dpath != root_dir:
+                state = check_dir(dpath.parent)
+                if state is None:
+                    pattern = exclude_match(dpath, 'directory', is_dir=True)
+                    if pattern:
+                        finfo(dpath, 'Skipping directory as matches %r', pattern)
+                        state = True
+                    elif is_generated(dpath, is_dir=True):
+                        finfo(dpath, 'Skipping directory as marked linguist-generated')
+                        state = True
+            if state is None:
+                kind = third_party_kind(dpath)
+                if kind:
+                    state = (dpath, kind)
+            dir_state[dpath] = state
+        return dir_state[dpath]
+
+    return check_dir
+
+
+def git_changed_files(base_ref):
+    """Get the files added or modified since `base_ref`.
+
+    The comparison is against the merge base of `base_ref` and `HEAD` (like
+    a pull request diff) and includes uncommitted changes in the working
+    tree. Deleted files are not included.
+
+    Returns paths relative to the current working directory.
+    """
+    merge_base = git('merge-base', base_ref, 'HEAD').decode('utf-8').strip()
+    logging.debug('Merge base of %s and HEAD is %s', base_ref, merge_base)
+    output = git(
+        'diff', '--name-only', '-z', '--relative', '--no-renames',
+        '--diff-filter=ACMRT', merge_base)
+    return [p for p in output.decode('utf-8').split('\0') if p]
+
+
+def changed_files(root_dir, paths, results):
+    """Yield the files from `paths` which should be checked.
+
+    Used with the output of `git_changed_files`. Applies the same directory
+    exclusion and third_party handling as `walk_files` to the parent
+    directories of each path, but only looks at the directories containing
+    changes. The third_party checks are run on the third_party directories
+    which own a changed file.
+    """
+    check_dir = dir_checker(root_dir)
+
+    third_party_dirs = set()
+    fpaths = []
+    for p in paths:
+        fpath = (root_dir / p).resolve()
+        if root_dir not in fpath.parents:
+            fdebug(fpath, 'Skipping as outside %s', root_dir)
+            continue
+
+        state = check_dir(fpath.parent)
+        if state is True:
+            continue
+        if state is not None:
+            third_party_dirs.add(state)
+            continue
 
-    return len(errors)
+        if not fpath.is_file():
+            fwarn(fpath, 'Skipping nonfile')
+            continue
 
+        if is_skipped_file(fpath):
+            continue
 
-# Extra functionality targeted at github actions
+        fpaths.append(fpath)
 
-MATCHER_OWNER = 'f4pga-checks'
+    for dpath, kind in sorted(third_party_dirs):
+        add_third_party_errors(dpath, results, kind)
 
+    yield from sorted(fpaths)
 
-def matcher_add():
+
+def tracked_files(root_dir, paths, results):
+    """Yield the files from `paths` which should be checked, as they come.
+
+    Used with the output of `git_tracked_files`, which only lists paths
+    under the current directory (`root_dir`), so untracked files (like build
+    outputs) are never looked at. The third_party checks are run on each
+    third_party directory containing tracked files the first time it is
+    seen.
     """
-    See https://github.com/actions/toolkit/blob/main/docs/commands.md#problem-matchers
+    check_dir = dir_checker(root_dir)
+
+    third_party_dirs = set()
+    for p in paths:
+        fpath = root_dir / p
+        state = check_dir(fpath.parent)
+        if state is True:
+            continue
+        if state is not None:
+            if state not in third_party_dirs:
+                third_party_dirs.add(state)
+                dpath, kind = state
+                add_third_party_errors(dpath, results, kind)
+            continue
+
+        # Tracked files deleted from the working tree, submodules which
+        # aren't checked out, ...
+        if not fpath.is_file():
+            fdebug(fpath, 'Skipping tracked path which is not a file')
+            continue
+
+        if is_skipped_file(fpath):
+            continue
+
+        yield fpath
 
-    The matcher json must be available in the **current** workspace.
-    See https://github.community/t/problem-matcher-not-found-in-docker-action/16814/2
 
-    Hence we read the matcher data from the docker container and then write it
-    out into the workspace before outputting the `::add-matcher` command.
+def batched(iterable, size):
+    """Split `iterable` into lists of at most `size` items.
+
+    >>> list(batched(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(batched([], 2))
+    []
     """
-    if not OUTPUT_ANNOTATIONS:
-        return
+    batch = []
+    for i in iterable:
+        batch.append(i)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    # Read in the problem_matcher.json data
-    infile = __path__ / 'problem_matcher.json'
-    with open(infile) as f:
-        data = f.read()
 
-    assert MATCHER_OWNER in data, (MATCHER_OWNER, data)
+# Number of files sent to a worker process at once.
+JOBS_BATCH_SIZE = 64
 
-    # Write out the problem_matcher.json data to a file in the local directory.
-    fname = 'f4pga_checks.json'
-    inside_docker = pathlib.Path('/github/workflow')
-    if inside_docker.exists():
-        logging.debug('Running inside GitHub Action docker container!')
-        outside_docker = pathlib.Path(os.environ['RUNNER_TEMP']) / '_github_workflow'
-    else:
-        logging.debug('Running outside docker container!')
-        inside_docker = pathlib.Path(tempfile.gettempdir())
-        outside_docker = inside_docker
+# Number of batches queued per worker process.
+JOBS_QUEUED_BATCHES = 4
 
-    logging.debug('Matcher will be written to: %s', inside_docker)
-    logging.debug('Matcher will be found at: %s', outside_docker)
 
-    with open(inside_docker / fname, 'w') as f:
-        f.write(data)
+def _init_worker(log_level, cache_entries, profiling, fix, checkers_config):
+    global _worker_cache_entries, _worker_fix, _profile
+    logging.basicConfig(level=log_level)
+    if checkers_config is not None and checkers_config != _checkers_config:
+        load_checkers_config(*checkers_config)
+    _worker_cache_entries = cache_entries
+    _worker_fix = fix
+    _profile = Profile() if profiling else None
+
+
+def run_checks(root_dir, jobs, base_ref=None, cache=None, reporters=(), profile=None,
+               fix=None, patch=None, tracked=False):
+    """Run the checks on all files under `root_dir`.
 
-    print('::add-matcher::{}'.format(outside_docker / fname))
+    When `base_ref` is given, only the files changed since `base_ref` are
+    checked. Otherwise when `tracked` is set, only the files tracked by git
+    are checked rather than walking the directory tree.
+
+    When `jobs` is greater than one, the per-file checks are spread over a
+    pool of worker processes while the directory walk continues in this
+    process.
+
+    When a `ResultCache` is given, the errors of unchanged files are taken
+    from it and it is updated with the new results.
+
+    Each `Finding` is passed to the `reporters` as soon as the batch of files
+    it is in has been checked.
+
+    When a `Profile` is given, the timing of the checks is added to it.
+
+    When `FixOptions` are given, the problems which can be fixed are, and the
+    patch of the fixes is written to the `patch` file.
+
+    Returns the `CheckResults`.
+    """
+    global _profile
 
+    results = CheckResults(reporters, patch=patch)
+    if profile is not None:
+        _profile = Profile()
+    try:
+        _run_checks(root_dir, jobs, base_ref, cache, results, profile, fix, tracked)
+        return results
+    finally:
+        if profile is not None:
+            profile.merge(_profile)
+            _profile = None
+
+
+def _run_checks(root_dir, jobs, base_ref, cache, results, profile, fix, tracked):
+    files = None
+    if base_ref:
+        try:
+            with profile_phase('git diff'):
+                paths = git_changed_files(base_ref)
+            logging.info('Checking %s files changed since %s', len(paths), base_ref)
+            files = changed_files(root_dir, paths, results)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(
+                'Unable to find files changed since %r (%s), checking all files.',
+                base_ref, e)
+    if files is None and tracked:
+        try:
+            git('rev-parse', '--is-inside-work-tree', stderr=subprocess.DEVNULL)
+            # Listed in full here so a failure of git falls back to the walk
+            # before any file is checked.
+            files = tracked_files(root_dir, list(git_tracked_files()), results)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(
+                'Unable to list the files tracked by git (%s), checking all files.', e)
+    if files is None:
+        files = walk_files(root_dir, results)
+
+    serial = not all(c.parallel for c in CHECKERS.values() if c.enabled)
+
+    def add_results(batch):
+        batch_results, batch_profile = batch
+        if batch_profile is not None:
+            profile.merge(batch_profile)
+        for fpath, findings, cache_entry, cache_hit, patch in batch_results:
+            if serial:
+                findings = findings + serial_check_file(fpath)
+            if patch:
+                results.add_fix(patch)
+            results.report(findings)
+            if cache is not None:
+                cache.update(str(fpath), cache_entry, cache_hit)
+
+    cache_entries = cache.entries if cache is not None else None
+
+    worker_args = (
+        logging.getLogger().getEffectiveLevel(),
+        cache_entries,
+        profile is not None,
+        fix,
+        _checkers_config,
+    )
 
-def matcher_remove():
-    if not OUTPUT_ANNOTATIONS:
+    if jobs <= 1:
+        _init_worker(*worker_args)
+        for batch in batched(files, JOBS_BATCH_SIZE):
+            add_results(check_files(batch))
         return
-    print('::remove-matcher owner={},::'.format(MATCHER_OWNER))
+
+    logging.debug('Running checks with %s jobs', jobs)
+    # Anything buffered would be output again by the forked workers.
+    sys.stdout.flush()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=worker_args) as executor:
+        # Collect the results of the batches as they finish while the walk
+        # continues, so findings are reported as soon as possible. Only a
+        # limited number of batches are queued so the results don't pile up
+        # in memory when the walk is faster than the checks.
+        pending = set()
+        for batch in batched(files, JOBS_BATCH_SIZE):
+            pending.add(executor.submit(check_files, batch))
+            if len(pending) < jobs * JOBS_QUEUED_BATCHES:
+                continue
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                add_results(future.result())
+        for future in concurrent.futures.as_completed(pending):
+            add_results(future.result())
+
+
+# Maximum number of annotations the Checks API accepts in a single request.
+ANNOTATIONS_PER_REQUEST = 50
+
+
+def escape_command_data(value, is_property=False):
+    """Escape a value for a workflow command.
+
+    See https://github.com/actions/toolkit/blob/main/packages/core/src/command.ts
+
+    >>> escape_command_data('100% wrong\\n')
+    '100%25 wrong%0A'
+    >>> escape_command_data('a,b:c', is_property=True)
+    'a%2Cb%3Ac'
+    """
+    value = value.replace('%', '%25').replace('\r', '%0D').replace('\n', '%0A')
+    if is_property:
+        value = value.replace(':', '%3A').replace(',', '%2C')
+    return value
+
+
+def annotation(finding):
+    """The Checks API annotation for a `Finding`.
+
+    >>> pprint.pprint(annotation(Finding('a.py', 2, 'python-coding', 'Bad')))
+    {'annotation_level': 'failure',
+     'end_line': 2,
+     'message': 'Bad',
+     'path': 'a.py',
+     'start_line': 2,
+     'title': 'python-coding'}
+    """
+    return {
+        'path': finding.path,
+        'start_line': finding.line,
+        'end_line': finding.line,
+        'annotation_level': 'failure',
+        'title': finding.rule or 'error',
+        'message': finding.message,
+    }
+
+
+class WorkflowCommandAnnotations:
+    """Outputs annotations as GitHub Actions workflow commands.
+
+    When `commands` is false, the annotations are only output as text.
+    """
+
+    def __init__(self, commands=True):
+        self.commands = commands
+
+    def send(self, annotations):
+        lines = []
+        for a in annotations:
+            if self.commands:
+                lines.append('::error file={},line={},title={}::{}\n'.format(
+                    escape_command_data(a['path'], True), a['start_line'],
+                    escape_command_data(a['title'], True),
+                    escape_command_data(a['message'])))
+            else:
+                lines.append(':error file={},line={},col=0:{}\n'.format(
+                    a['path'], a['start_line'], a['message']))
+        # A single write per batch so the lines aren't interleaved with other
+        # output.
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
+
+    def finish(self, total, notes):
+        for note in notes:
+            print(f'::warning::{note}')
+
+
+class ChecksApiAnnotations:
+    """Creates a check run with the annotations using the GitHub Checks API.
+
+    See https://docs.github.com/en/rest/checks/runs
+
+    The check run is created with the first batch of annotations, further
+    batches are added by updating it and it is completed by `finish()`.
+    """
+
+    name = TOOL_NAME
+
+    def __init__(self, api_url, repository, head_sha, token):
+        self.url = '{}/repos/{}/check-runs'.format(api_url.rstrip('/'), repository)
+        self.head_sha = head_sha
+        self.token = token
+        self.check_run_id = None
+
+    @classmethod
+    def from_environment(cls, token):
+        return cls(
+            os.environ.get('GITHUB_API_URL', 'https://api.github.com'),
+            os.environ['GITHUB_REPOSITORY'],
+            os.environ['GITHUB_SHA'],
+            token)
+
+    def request(self, method, url, body):
+        import urllib.request
+        req = urllib.request.Request(
+            url, method=method, data=json.dumps(body).encode('utf-8'), headers={
+                'Accept': 'application/vnd.github+json',
+                'Authorization': f'Bearer {self.token}',
+                'Content-Type': 'application/json',
+            })
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return json.load(response)
+
+    def update(self, body):
+        if self.check_run_id is None:
+            body = dict(name=self.name, head_sha=self.head_sha, **body)
+            self.check_run_id = self.request('POST', self.url, body)['id']
+        else:
+            self.request('PATCH', f'{self.url}/{self.check_run_id}', body)
+
+    def send(self, annotations):
+        self.update({
+            'status': 'in_progress',
+            'output': {
+                'title': self.name,
+                'summary': 'Running the checks.',
+                'annotations': annotations,
+            },
+        })
+
+    def finish(self, total, notes):
+        summary = ['Found {} problems.'.format(total)] + notes
+        self.update({
+            'status': 'completed',
+            'conclusion': 'failure' if total else 'success',
+            'output': {
+                'title': self.name,
+                'summary': '\n\n'.join(summary),
+            },
+        })
+
+
+class FileAnnotations(ChecksApiAnnotations):
+    """Writes the Checks API requests to a file rather than sending them.
+
+    Each request is written as a JSON object with the `method`, `url` and
+    `body`, one per line.
+    """
+
+    def __init__(self, path):
+        super().__init__('https://api.github.com', 'OWNER/REPO',
+                         os.environ.get('GITHUB_SHA', 'HEAD'), None)
+        self.path = path
+        # Create the file, even when there is nothing to send.
+        open(path, 'w').close()
+
+    def request(self, method, url, body):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'method': method, 'url': url, 'body': body}, sort_keys=True))
+            f.write('\n')
+        return {'id': 1}
+
+
+class AnnotationReporter:
+    """Outputs the GitHub annotations for each `Finding`.
+
+    The annotations are sent by a background thread to the `backend` in
+    batches of `ANNOTATIONS_PER_REQUEST`, so a slow backend doesn't hold up
+    the checks. Identical findings are only annotated once.
+
+    GitHub only shows a limited number of annotations, so at most `limit`
+    annotations are sent for each rule (`0` for no limit). The number of
+    problems which were not annotated is reported at the end.
+
+    Problems which aren't about a line of a file are output as `::error::`
+    workflow commands straight away, whatever the backend.
+
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(tmp.name, 'annotations.jsonl')
+    >>> r = AnnotationReporter(FileAnnotations(path), limit=1)
+    >>> r.add([Finding('a.py', 1, 'x', 'm'), Finding('a.py', 1, 'x', 'm'),
+    ...        Finding('b.py', 1, 'x', 'm'), Finding(None, None, 'y', 'oops')])
+    ::error::oops
+    >>> r.close()
+    >>> with open(path) as f:
+    ...     requests = [json.loads(line) for line in f]
+    >>> [(r['method'], r['body']['status']) for r in requests]
+    [('POST', 'in_progress'), ('PATCH', 'completed')]
+    >>> [a['path'] for a in requests[0]['body']['output']['annotations']]
+    ['a.py']
+    >>> print(requests[1]['body']['output']['summary'])
+    Found 2 problems.
+    <BLANKLINE>
+    Only the first 1 of 2 x errors were annotated.
+    >>> tmp.cleanup()
+    """
+
+    def __init__(self, backend, limit):
+        import queue
+        import threading
+        self.backend = backend
+        self.limit = limit
+        self.counts = collections.Counter()
+        self.sent = collections.Counter()
+        self.seen = set()
+        self.failed = False
+        self.queue = queue.Queue()
+        self.thread = None
+        if backend is not None:
+            self.thread = threading.Thread(
+                target=self._send_annotations, name='annotations', daemon=True)
+            self.thread.start()
+
+    def add(self, findings):
+        for finding in findings:
+            if finding.line is None:
+                print(f'::error::{finding.message}')
+                continue
+            key = (finding.path, finding.line, finding.rule, finding.message)
+            if key in self.seen:
+                logging.debug('Duplicate finding: %s', finding)
+                continue
+            rule = finding.rule or 'error'
+            self.counts[rule] += 1
+            if self.limit and self.sent[rule] >= self.limit:
+                continue
+            self.sent[rule] += 1
+            # Only the annotated findings are kept, so the memory used is
+            # bounded by the limit.
+            self.seen.add(key)
+            if self.backend is not None:
+                self.queue.put(annotation(finding))
+
+    def _send_annotations(self):
+        import queue
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < ANNOTATIONS_PER_REQUEST and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            if batch and not self.failed:
+                self._call(self.backend.send, batch)
+            if done:
+                return
+
+    def _call(self, method, *args):
+        try:
+            method(*args)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Unable to output annotations: %s', e)
+            self.failed = True
+
+    def close(self):
+        if self.backend is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+        notes = []
+        for rule, n in sorted(self.counts.items()):
+            if n > self.sent[rule]:
+                notes.append('Only the first {} of {} {} errors were annotated.'.format(
+                    self.sent[rule], n, rule))
+        if not self.failed:
+            self._call(self.backend.finish, sum(self.counts.values()), notes)
+
+
+class JsonLinesReporter:
+    """Writes each `Finding` as a JSON object on its own line.
+
+    The file is flushed after each batch of findings so it can be followed
+    while the checks are still running.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w')
+
+    def add(self, findings):
+        for finding in findings:
+            self.f.write(finding.to_json())
+            self.f.write('\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class SarifReporter:
+    """Writes the findings as a SARIF log.
+
+    The results are written out as they are found, so they don't need to be
+    kept in memory until the end.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w')
+        self.count = 0
+
+        rules = [
+            {'id': rule, 'shortDescription': {'text': description}}
+            for rule, description in sorted(RULES.items())
+        ]
+        header = json.dumps({
+            '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+            'version': '2.1.0',
+            'runs': [{
+                'tool': {'driver': {
+                    'name': TOOL_NAME,
+                    'informationUri': 'https://github.com/f4pga/actions',
+                    'rules': rules,
+                }},
+                'results': [],
+            }],
+        }, indent=2)
+        # Split at the empty results list so they can be streamed in.
+        marker = '"results": []'
+        assert header.count(marker) == 1, header
+        self.prefix, self.suffix = header.split(marker)
+        self.f.write(self.prefix + '"results": [')
+
+    @staticmethod
+    def result(finding):
+        r = {
+            'ruleId': finding.rule or 'error',
+            'level': 'error',
+            'message': {'text': finding.message},
+        }
+        if finding.path is not None:
+            location = {'artifactLocation': {'uri': finding.path}}
+            if finding.line is not None:
+                location['region'] = {'startLine': finding.line}
+            r['locations'] = [{'physicalLocation': location}]
+        return r
+
+    def add(self, findings):
+        for finding in findings:
+            if self.count:
+                self.f.write(',')
+            self.f.write('\n        ')
+            self.f.write(json.dumps(self.result(finding), sort_keys=True))
+            self.count += 1
+
+    def close(self):
+        if self.count:
+            self.f.write('\n      ')
+        self.f.write(']' + self.suffix + '\n')
+        self.f.close()
+
+
+def default_jobs():
+    """Number of jobs to use when none are requested, one per core."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parse_args(args):
+    """Parse the command line arguments.
+
+    Defaults come from the `INPUT_XXX` environment variables which GitHub
+    Actions sets from the action inputs.
+
+    >>> parse_args(['checks.py', '--jobs', '3']).jobs
+    3
+    >>> parse_args(['checks.py']).jobs == default_jobs()
+    True
+    """
+    parser = argparse.ArgumentParser(
+        prog=pathlib.Path(args[0]).name if args else None,
+        description='License and other basic checks.')
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        default=int(os.environ.get('INPUT_JOBS', '').strip() or 0),
+        help='Number of files to check in parallel (default: number of cores).')
+    parser.add_argument(
+        '--base-ref',
+        default=os.environ.get('INPUT_BASE_REF', '').strip() or None,
+        help='Only check files added or modified since this git ref.')
+    parser.add_argument(
+        '--tracked', action='store_true',
+        default=os.environ.get('INPUT_TRACKED', 'false').lower() in ('1', 'true'),
+        help='Only check the files tracked by git, rather than all the files '
+             'found under the current directory.')
+    parser.add_argument(
+        '--config',
+        default=os.environ.get('INPUT_CONFIG', '').strip() or CONFIG_FILE,
+        help='Configuration file enabling, disabling and adding checkers '
+             '(default: %(default)s).')
+    parser.add_argument(
+        '--plugins', action='store_true',
+        default=os.environ.get('INPUT_PLUGINS', 'false').lower() in ('1', 'true'),
+        help='Add the checkers from Python files in the repository listed in '
+             'the configuration file.')
+    parser.add_argument(
+        '--cache-dir',
+        default=os.environ.get('INPUT_CACHE_DIR', '').strip() or None,
+        help='Directory to keep the results of unchanged files between runs in.')
+    parser.add_argument(
+        '--jsonl',
+        default=os.environ.get('INPUT_JSONL', '').strip() or None,
+        help='Write each problem found to this file as a JSON Lines record.')
+    parser.add_argument(
+        '--sarif',
+        default=os.environ.get('INPUT_SARIF', '').strip() or None,
+        help='Write the problems found to this file as a SARIF log.')
+    parser.add_argument(
+        '--annotation-limit', type=int,
+        default=int(os.environ.get('INPUT_ANNOTATION_LIMIT', '').strip() or 10),
+        help='Maximum number of annotations output for each rule (0 for no limit).')
+    parser.add_argument(
+        '--annotation-backend', choices=('workflow', 'checks-api', 'file'),
+        default=os.environ.get('INPUT_ANNOTATION_BACKEND', '').strip() or 'workflow',
+        help='Output the annotations as workflow commands (the default), with '
+             'the GitHub Checks API or write the Checks API requests to '
+             '--annotation-file.')
+    parser.add_argument(
+        '--annotation-file',
+        default=os.environ.get('INPUT_ANNOTATION_FILE', '').strip() or None,
+        help='File to write the Checks API requests to with the file backend.')
+    parser.add_argument(
+        '--summary-limit', type=int,
+        default=int(os.environ.get('INPUT_SUMMARY_LIMIT', '').strip() or 1000),
+        help='Only output error counts in the summary when more paths than '
+             'this have errors (0 for no limit).')
+    parser.add_argument(
+        '--fix', action='store_true',
+        default=os.environ.get('INPUT_FIX', 'false').lower() in ('1', 'true'),
+        help='Fix the problems which can be fixed automatically, in place.')
+    parser.add_argument(
+        '--patch',
+        default=os.environ.get('INPUT_PATCH', '').strip() or None,
+        help='Write the fixes to this file as a patch. Without --fix, the '
+             'files are not changed.')
+    parser.add_argument(
+        '--spdx-license',
+        default=os.environ.get('INPUT_SPDX_LICENSE', '').strip() or None,
+        help='SPDX license expression added to the files missing a '
+             'SPDX-License-Identifier line when fixing.')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='Keep running, checking the files as they change, and answer '
+             '--query from other runs.')
+    parser.add_argument(
+        '--query', action='store_true',
+        help='Get the results from the --watch daemon running on the current '
+             'directory, rather than running the checks.')
+    parser.add_argument(
+        '--socket',
+        help='Unix socket the --watch daemon listens on (default: one in the '
+             'temporary directory for the current directory).')
+    parser.add_argument(
+        '--poll-interval', type=float,
+        help='Look for changes every this many seconds with --watch, rather '
+             'than with inotify.')
+    parser.add_argument(
+        '--profile', action='store_true',
+        default=os.environ.get('INPUT_PROFILE', 'false').lower() in ('1', 'true'),
+        help='Output where the time running the checks was spent.')
+    parser.add_argument(
+        '--profile-json',
+        default=os.environ.get('INPUT_PROFILE_JSON', '').strip() or None,
+        help='Write the profiling information to this file as JSON.')
+
+    opts = parser.parse_args(args[1:])
+    if opts.annotation_backend == 'file' and not opts.annotation_file:
+        parser.error('--annotation-file is needed with the file annotation backend')
+    if opts.watch and (opts.query or opts.fix or opts.patch):
+        parser.error('--watch can not be used with --query, --fix or --patch')
+    if opts.jobs <= 0:
+        opts.jobs = default_jobs()
+    return opts
+
+
+def annotation_backend(opts):
+    """The annotation backend to use, `None` to not output annotations."""
+    if opts.annotation_backend == 'file':
+        return FileAnnotations(opts.annotation_file)
+    if opts.annotation_backend == 'checks-api':
+        token = os.environ.get('INPUT_GITHUB_TOKEN', '').strip() or os.environ.get('GITHUB_TOKEN')
+        if token:
+            return ChecksApiAnnotations.from_environment(token)
+        logging.warning('No GitHub token, outputting the annotations as workflow commands.')
+    if ON_GITHUB_ACTIONS:
+        return WorkflowCommandAnnotations(commands=OUTPUT_ANNOTATIONS)
+    return None
+
+
+def import_watch():
+    """Import the `watch` module, which is only needed by the watch mode."""
+    # When running as a script, make `import checks` find this module rather
+    # than loading a second copy.
+    sys.modules.setdefault('checks', sys.modules[__name__])
+    import watch
+    return watch
 
 
-def github_actions_main(args):
-    matcher_add()
+def main(args):
+    start_time = time.perf_counter()
+    opts = parse_args(args)
+
+    root_dir = pathlib.Path().resolve()
+    logging.debug('Starting search in: %s', root_dir)
+
+    try:
+        load_checkers_config(opts.config, root_dir, opts.plugins)
+    except (OSError, ValueError) as e:
+        logging.error('Invalid configuration file %s: %s', opts.config, e)
+        return 1
+
+    cache = None
+    if opts.cache_dir:
+        cache = ResultCache(opts.cache_dir)
+        cache.load()
+
+    if opts.watch or opts.query:
+        watch = import_watch()
+        socket_path = opts.socket or watch.default_socket_path(root_dir)
+    if opts.watch:
+        return watch.run_daemon(root_dir, socket_path, opts.jobs, cache, opts.poll_interval)
+
+    profile = None
+    if opts.profile or opts.profile_json:
+        profile = Profile()
+
+    fix = None
+    if opts.fix or opts.patch:
+        fix = FixOptions(write=opts.fix, spdx_license=opts.spdx_license)
+
+    reporters = [AnnotationReporter(annotation_backend(opts), opts.annotation_limit)]
+    if opts.jsonl:
+        reporters.append(JsonLinesReporter(opts.jsonl))
+    if opts.sarif:
+        reporters.append(SarifReporter(opts.sarif))
+
+    with contextlib.ExitStack() as stack:
+        patch = None
+        if opts.patch:
+            patch = stack.enter_context(open(opts.patch, 'w'))
+        try:
+            results = None
+            if opts.query:
+                results = watch.query_results(socket_path, reporters)
+            if results is None:
+                results = run_checks(
+                    root_dir, opts.jobs, opts.base_ref, cache, reporters, profile,
+                    fix, patch, opts.tracked)
+                # Only the changed files are checked with a base ref.
+                if cache is not None and not opts.base_ref:
+                    cache.drop_unseen()
+        finally:
+            for reporter in reporters:
+                reporter.close()
+
+    if results.fixed_paths:
+        if opts.fix:
+            print('Fixed {} files.'.format(results.fixed_paths))
+        else:
+            print('Found fixes for {} files.'.format(results.fixed_paths))
+        if opts.patch:
+            print('The fixes were written to {}.'.format(opts.patch))
+
+    if cache is not None:
+        cache.save()
+
     try:
-        return main(args)
+        results.print_summary(opts.summary_limit)
     finally:
-        matcher_remove()
+        results.close()
+
+    if cache is not None:
+        cache.print_stats()
+
+    if profile is not None:
+        wall_time = time.perf_counter() - start_time
+        if opts.profile:
+            profile.print_summary(wall_time)
+        if opts.profile_json:
+            with open(opts.profile_json, 'w') as f:
+                json.dump(profile.to_json(wall_time), f, indent=2)
+
+    return results.error_paths
 
 
 if __name__ == "__main__":
@@ -619,7 +3596,4 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO)
 
-    if ON_GITHUB_ACTIONS:
-        sys.exit(github_actions_main(sys.argv))
-    else:
-        sys.exit(main(sys.argv))
+    sys.exit(main(sys.argv))
@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""The watch mode of `checks.py`, keeping the results up to date.
+
+Only imported with `--watch` and `--query`, so the modules it needs aren't
+loaded by the other runs of the checks.
+"""
+
+
+import concurrent.futures
+import errno
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import selectors
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+import checks
+
+
+class Inotify:
+    """Watches directories for changes with the Linux inotify API.
+
+    The API is used through `ctypes`, `Inotify.open` returns `None` where it
+    isn't available. `ctypes` is only imported when watching, as it is large.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+    # The header of each `struct inotify_event`, followed by the name.
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, libc, fd, get_errno):
+        self._libc = libc
+        self._get_errno = get_errno
+        self.fd = fd
+        self._paths = {}
+        self._watches = {}
+
+    @classmethod
+    def open(cls):
+        if not sys.platform.startswith('linux'):
+            return None
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logging.debug('Unable to use inotify: %s', e)
+            return None
+        if fd < 0:
+            logging.debug('Unable to use inotify: %s', os.strerror(ctypes.get_errno()))
+            return None
+        return cls(libc, fd, ctypes.get_errno)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def add_watch(self, dpath):
+        if dpath in self._paths:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dpath), self.MASK)
+        if wd < 0:
+            # Most likely `fs.inotify.max_user_watches` has been reached.
+            checks.fwarn(dpath, 'Unable to watch directory: %s', os.strerror(self._get_errno()))
+            return
+        self._paths[dpath] = wd
+        self._watches[wd] = dpath
+
+    def remove_tree(self, dpath):
+        """Stop watching `dpath` and the directories under it."""
+        prefix = os.path.join(str(dpath), '')
+        for path in [p for p in self._paths if p == dpath or str(p).startswith(prefix)]:
+            wd = self._paths.pop(path)
+            del self._watches[wd]
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Read the pending events.
+
+        Returns a list of the path and mask of each event, the path is `None`
+        when events were lost.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset+size].rstrip(b'\0')
+                offset += size
+                if mask & self.IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                dpath = self._watches.get(wd)
+                if mask & self.IN_IGNORED:
+                    # The directory was removed.
+                    if dpath is not None:
+                        del self._watches[wd]
+                        del self._paths[dpath]
+                    continue
+                # Events about the watched directory itself aren't needed,
+                # its parent is watched too.
+                if dpath is None or not name:
+                    continue
+                events.append((dpath / os.fsdecode(name), mask))
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Seconds between looking for changes when inotify isn't available.
+POLL_INTERVAL = 2.0
+
+# Seconds a client waits for the daemon to answer.
+QUERY_TIMEOUT = 60.0
+
+
+def default_socket_path(root_dir):
+    """The socket the checks daemon for `root_dir` listens on by default."""
+    digest = hashlib.sha256(os.fsencode(root_dir)).hexdigest()[:16]
+    return os.path.join(
+        tempfile.gettempdir(), '{}-{}-{}.sock'.format(checks.TOOL_NAME, os.getuid(), digest))
+
+
+def listen_unix_socket(socket_path):
+    """Listen on the Unix socket `socket_path`.
+
+    A socket file left behind by a daemon which didn't exit cleanly is
+    replaced, an `OSError` is raised when a daemon is still listening on it.
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            server.bind(socket_path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(socket_path) == 0:
+                    raise OSError(
+                        errno.EADDRINUSE, 'A checks daemon is already listening',
+                        socket_path)
+            os.unlink(socket_path)
+            server.bind(socket_path)
+        server.listen()
+    except OSError:
+        server.close()
+        raise
+    return server
+
+
+class CheckDaemon:
+    """Keeps the results of the checks on `root_dir` up to date.
+
+    The tree is checked once, after that only the files which change are
+    checked again. The size and modification time and the `Finding`s of
+    each file, the third_party findings and the exclude decisions for each
+    directory are kept in memory.
+
+    Changes are found with inotify, or when it isn't available (or a
+    `poll_interval` is given) by walking the tree again every `poll_interval`
+    seconds and before answering each query. A change to a `.gitattributes`
+    file or lost inotify events cause the whole tree to be checked again.
+
+    `serve` answers queries from `query_daemon` on the Unix socket at
+    `socket_path`.
+
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> root = pathlib.Path(tmp.name)
+    >>> _ = (root / 'a.sh').write_text('#!/bin/bash\\n')
+    >>> daemon = CheckDaemon(root, None)
+    >>> daemon.reset()
+    >>> [f.rule for f in daemon.findings()]
+    ['license-spdx']
+    >>> _ = (root / 'a.sh').write_text('#!/bin/bash\\n# SPDX-License-Identifier: MIT\\n')
+    >>> _ = (root / 'b.py').write_text('x = 1\\n')
+    >>> daemon.update_tree()
+    >>> sorted(f.rule for f in daemon.findings())
+    ['license-spdx', 'python-coding', 'python-shebang']
+    >>> (root / 'b.py').unlink()
+    >>> daemon.update_tree()
+    >>> daemon.findings()
+    []
+    >>> tmp.cleanup()
+    """
+
+    def __init__(self, root_dir, socket_path, jobs=1, cache=None, poll_interval=None):
+        self.root_dir = root_dir
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.inotify = None
+        # The size and modification time and the findings of each file.
+        self.files = {}
+        # The size and modification time of each `.gitattributes` file.
+        self.attributes = {}
+        # The license files and the findings of each third_party directory.
+        self.third_party = {}
+        # Set once the whole tree has been checked.
+        self.ready = False
+        self._reset = False
+        self._check_dir = checks.dir_checker(root_dir)
+        self._worker_args = (
+            logging.getLogger().getEffectiveLevel(),
+            cache.entries if cache is not None else None,
+            False,
+            None,
+            checks._checkers_config,
+        )
+
+    def findings(self):
+        """All the `Finding`s, sorted by path."""
+        findings = []
+        for _, dir_findings in self.third_party.values():
+            findings.extend(dir_findings)
+        for _, file_findings in self.files.values():
+            findings.extend(file_findings)
+        findings.sort(key=lambda f: checks.CheckResults.sort_key(f.path or '', f.message))
+        return findings
+
+    def reset(self):
+        """Forget everything and check the whole tree again."""
+        checks._gitattributes = None
+        self._check_dir = checks.dir_checker(self.root_dir)
+        self.files = {}
+        self.attributes = {}
+        self.third_party = {}
+        self.ready = False
+        self.refresh()
+        self.ready = True
+
+    def refresh(self):
+        """Walk the whole tree, checking the files which changed."""
+        seen = set()
+        changed = self.scan(self.root_dir, seen)
+        for fpath in (self.files.keys() | self.attributes.keys()) - seen:
+            self.forget(fpath)
+        for dpath in self.third_party.keys() - seen:
+            del self.third_party[dpath]
+        self.check(changed)
+
+    def update_tree(self):
+        """Check the files which changed since the last update."""
+        if self.inotify is not None:
+            self.process_events(self.inotify.read())
+        else:
+            self.refresh()
+        if self._reset:
+            self._reset = False
+            logging.info('Checking the whole tree again.')
+            self.reset()
+
+    def scan(self, dpath, seen):
+        """Walk `dpath` like `walk_files`, watching each directory.
+
+        Adds the files and third_party directories found to `seen` and
+        returns the files which changed.
+        """
+        changed = []
+        to_search = [dpath]
+        while to_search:
+            rpath = to_search.pop()
+            state = self._check_dir(rpath)
+            if state is True:
+                continue
+            if state is not None:
+                seen.add(rpath)
+                self.check_third_party(state)
+                continue
+            if self.inotify is not None:
+                self.inotify.add_watch(rpath)
+            dirs, files, _ = checks.scan_dir(rpath)
+            to_search.extend(rpath / dname for dname in reversed(dirs))
+            for fname in files:
+                fpath = rpath / fname
+                seen.add(fpath)
+                if self.update(fpath):
+                    changed.append(fpath)
+        return changed
+
+    def update(self, fpath):
+        """Note `fpath` may have changed, returns if it needs checking."""
+        try:
+            st = fpath.stat()
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.forget(fpath)
+            return False
+
+        key = (st.st_size, st.st_mtime_ns)
+        if fpath.name == checks.GitAttributes.FILENAME:
+            if self.ready and self.attributes.get(fpath) != key:
+                self._reset = True
+            self.attributes[fpath] = key
+            return False
+
+        if checks.is_skipped_file(fpath):
+            self.forget(fpath)
+            return False
+
+        old = self.files.get(fpath)
+        if old is not None and old[0] == key:
+            return False
+        self.files[fpath] = (key, old[1] if old is not None else [])
+        return True
+
+    def forget(self, fpath):
+        self.files.pop(fpath, None)
+        if self.cache is not None:
+            self.cache.entries.pop(str(fpath), None)
+        if self.attributes.pop(fpath, None) is not None and self.ready:
+            self._reset = True
+
+    def forget_tree(self, dpath):
+        prefix = os.path.join(str(dpath), '')
+        for fpath in [p for p in self.files.keys() | self.attributes.keys()
+                      if str(p).startswith(prefix)]:
+            self.forget(fpath)
+        for tpath in [p for p in self.third_party
+                      if p == dpath or str(p).startswith(prefix)]:
+            del self.third_party[tpath]
+        if self.inotify is not None:
+            self.inotify.remove_tree(dpath)
+
+    def check_third_party(self, state):
+        """Run the third_party checks when its license files changed."""
+        dpath, kind = state
+        if not dpath.is_dir():
+            self.third_party.pop(dpath, None)
+            return
+
+        projects = [dpath]
+        if kind == 'directory':
+            projects = [dpath / dname for dname in checks.scan_dir(dpath)[0]]
+        key = []
+        for ppath in projects:
+            # Watch for license files being added or removed.
+            if self.inotify is not None:
+                self.inotify.add_watch(ppath)
+            for fname in checks.scan_dir(ppath)[1]:
+                if fname.lower() in checks.LICENSE_FILE_NAMES:
+                    st = os.stat(ppath / fname)
+                    key.append((fname, st.st_size, st.st_mtime_ns))
+            key.append(ppath)
+        if self.inotify is not None:
+            self.inotify.add_watch(dpath)
+
+        old = self.third_party.get(dpath)
+        if old is not None and old[0] == key:
+            return
+        with checks.recording_findings() as findings:
+            checks.third_party_checks(dpath, project=(kind == 'project'))
+        self.third_party[dpath] = (key, findings)
+
+    def check(self, fpaths):
+        """Run the checks on the files which changed."""
+        if not fpaths:
+            return
+        if self.ready:
+            logging.info('Checking %s changed files', len(fpaths))
+
+        if self.jobs > 1 and len(fpaths) > checks.JOBS_BATCH_SIZE:
+            # Anything buffered would be output again by the forked workers.
+            sys.stdout.flush()
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    initializer=checks._init_worker,
+                    initargs=self._worker_args) as executor:
+                for batch in executor.map(checks.check_files, checks.batched(fpaths, checks.JOBS_BATCH_SIZE)):
+                    self.add_results(batch)
+            return
+
+        checks._init_worker(*self._worker_args)
+        for fpath in fpaths:
+            try:
+                self.add_results(checks.check_files([fpath]))
+            except OSError as e:
+                # Removed while being checked, the event will follow.
+                checks.fdebug(fpath, 'Unable to check file: %s', e)
+                self.forget(fpath)
+
+    def add_results(self, batch):
+        batch_results, _ = batch
+        serial = not all(c.parallel for c in checks.CHECKERS.values() if c.enabled)
+        for fpath, findings, cache_entry, cache_hit, _ in batch_results:
+            if serial:
+                findings = findings + checks.serial_check_file(fpath)
+            if fpath in self.files:
+                self.files[fpath] = (self.files[fpath][0], findings)
+            if self.cache is not None:
+                self.cache.update(str(fpath), cache_entry, cache_hit)
+
+    def process_events(self, events):
+        """Check the files changed by the inotify `events`."""
+        changed = []
+        third_party = set()
+        for path, mask in events:
+            if path is None:
+                logging.warning('Some changes to the tree were missed.')
+                self._reset = True
+                continue
+            state = self._check_dir(path.parent)
+            if state is True:
+                continue
+            if state is not None:
+                third_party.add(state)
+                continue
+            if not mask & Inotify.IN_ISDIR:
+                if self.update(path):
+                    changed.append(path)
+            elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                changed += self.scan(path, set())
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self.forget_tree(path)
+        for state in third_party:
+            self.check_third_party(state)
+        self.check(changed)
+
+    def answer(self, server):
+        """Answer a query from a client connecting to `server`."""
+        conn, _ = server.accept()
+        with conn:
+            conn.settimeout(QUERY_TIMEOUT)
+            try:
+                with conn.makefile('rb') as f:
+                    request = json.loads(f.readline() or b'{}')
+                if request.get('command', 'findings') == 'findings':
+                    self.update_tree()
+                    response = {
+                        'files': len(self.files),
+                        'findings': self.findings(),
+                    }
+                else:
+                    response = {'error': 'Unknown command {!r}'.format(request.get('command'))}
+                conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+            except (OSError, ValueError, AttributeError) as e:
+                logging.warning('Unable to answer query: %s', e)
+
+    def serve(self):
+        """Check the tree then answer queries, until interrupted."""
+        timeout = self.poll_interval
+        if not timeout:
+            self.inotify = Inotify.open()
+            if self.inotify is None:
+                logging.warning('inotify is not available, polling for changes.')
+                timeout = POLL_INTERVAL
+
+        server = listen_unix_socket(self.socket_path)
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(server, selectors.EVENT_READ)
+                if self.inotify is not None:
+                    selector.register(self.inotify.fd, selectors.EVENT_READ)
+
+                self.reset()
+                logging.info(
+                    'Checked %s files, watching for changes %s. Listening on %s',
+                    len(self.files),
+                    'in {} directories'.format(len(self.inotify))
+                    if self.inotify is not None else 'every {}s'.format(timeout),
+                    self.socket_path)
+
+                while True:
+                    ready = selector.select(timeout if self.inotify is None else None)
+                    if not ready:
+                        self.update_tree()
+                    for key, _ in ready:
+                        if key.fileobj is server:
+                            self.answer(server)
+                        else:
+                            self.update_tree()
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+
+def query_daemon(socket_path):
+    """Get the `Finding`s from the `CheckDaemon` listening on `socket_path`."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(QUERY_TIMEOUT)
+        client.connect(socket_path)
+        client.sendall(json.dumps({'command': 'findings'}).encode('utf-8') + b'\n')
+        with client.makefile('rb') as f:
+            response = json.loads(f.readline())
+    if 'error' in response:
+        raise ValueError(response['error'])
+    logging.info('%s files checked by the daemon at %s', response['files'], socket_path)
+    return [checks.Finding(*f) for f in response['findings']]
+
+
+def query_results(socket_path, reporters):
+    """The `CheckResults` from the checks daemon, `None` when there is none."""
+    try:
+        findings = query_daemon(socket_path)
+    except (OSError, ValueError) as e:
+        logging.warning('Unable to query the checks daemon (%s), running the checks.', e)
+        return None
+    results = checks.CheckResults(reporters)
+    results.report(findings)
+    return results
+
+
+def run_daemon(root_dir, socket_path, jobs, cache, poll_interval):
+    """Run a `CheckDaemon` until it is stopped, returns the exit code."""
+    daemon = CheckDaemon(root_dir, socket_path, jobs, cache, poll_interval)
+    # Clean up the socket when stopped.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        logging.error('Unable to run the checks daemon: %s', e)
+        return 1
+    finally:
+        if cache is not None:
+            cache.save()
+    return 0
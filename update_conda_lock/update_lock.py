@@ -20,38 +20,50 @@
 """Module updating the Conda Lock."""
 
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import hashlib
 import io
+import json
 import os
 from os.path import dirname, exists, isdir, join, splitext
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
-from typing import List, Optional
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
 from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
 
 
 yaml = YAML()
 yaml.allow_duplicate_keys = True
 
 
-def _run(cmd_string: str, multiword_last_arg: str = '',
-         return_stdout: bool = False, **kwargs) -> Optional[str]:
+def _run(cmd_string: str, multiword_last_arg: Union[str, List[str]] = '',
+         return_stdout: bool = False, quiet: bool = False,
+         **kwargs) -> Optional[str]:
     """Runs a subprocess based on a string command.
 
     It's a wrapper for `subprocess.run` that can be used with a multi-argument
       command passed as a single string.
 
     The subprocess's exit code is always checked (`check=True`). In case of a
-      failure, captured `stdout` is always printed.
+      failure, captured `stdout` is printed unless `quiet` is set.
 
     Args:
       cmd_string: Command to be passed to `subprocess.run` after splitting.
       multiword_last_arg: Argument to be passed after `cmd_string`. It will
-        be passed as a single argument.
+        be passed as a single argument. A list of such arguments can also be
+        passed.
       return_stdout: Whether to capture and return subprocess's `stdout`.
         `encoding='utf-8'` is automatically passed to `subprocess.run`.
+      quiet: Whether to leave printing captured `stdout` on a failure to the
+        caller, e.g., when running in a thread.
 
     Keyword Args:
       All keyword arguments are passed to `subprocess.run`.
@@ -61,15 +73,18 @@ def _run(cmd_string: str, multiword_last_arg: str = '',
         `True`; `None` otherwise (the default).
     """
 
-    cmd = cmd_string.split() + (
-            [multiword_last_arg] if multiword_last_arg else [])
+    if isinstance(multiword_last_arg, str):
+        multiword_last_arg = (
+                [multiword_last_arg] if multiword_last_arg else [])
+    cmd = cmd_string.split() + multiword_last_arg
     if return_stdout:
         try:
             return subprocess.run(
                     cmd, check=True, encoding='utf-8', stdout=subprocess.PIPE,
                     **kwargs).stdout
         except subprocess.CalledProcessError as error:
-            print(error.output)
+            if not quiet:
+                print(error.output)
             raise
     else:
         subprocess.run(cmd, check=True, **kwargs)
@@ -136,7 +151,8 @@ def try_updating_lock_file(lock_path: str, lock_yml: dict) -> bool:
 
 
 def analyze_pip_requirement(
-        requirement: str, analyzed_file_dir: str) -> List[str]:
+        requirement: str, analyzed_file_dir: str,
+        req_paths: Optional[List[str]] = None) -> List[str]:
     """Analyzes a single line from pip's `requirements.txt` file.
 
     Such a line can be either a single package or a whole new
@@ -145,6 +161,8 @@ def analyze_pip_requirement(
     Args:
       requirement: Line from `requirements.txt` file.
       analyzed_file_dir: Parent directory of the file containing `requirement`.
+      req_paths: List the paths of the `requirements.txt` files read are
+        appended to.
 
     Returns:
       List[str]: List with all pip packages represented by the `requirement`.
@@ -162,17 +180,21 @@ def analyze_pip_requirement(
     # `-r PATH` is relative to the environment file
     req_path = join(analyzed_file_dir, path_match.group(2))
     print('Found additional pip requirements file: ' + req_path)
+    if req_paths is not None:
+        req_paths.append(req_path)
     with open(req_path, 'r') as req_file:
         file_requirements = []
         for req_line in req_file.readlines():
             file_requirements.extend(
-                    analyze_pip_requirement(req_line, dirname(req_path))
+                    analyze_pip_requirement(
+                            req_line, dirname(req_path), req_paths)
             )
         return file_requirements
 
 
 def flatten_pip_dependencies(
-        pip_dependencies: List[str], analyzed_file_dir: str) -> List[str]:
+        pip_dependencies: List[str], analyzed_file_dir: str,
+        req_paths: Optional[List[str]] = None) -> List[str]:
     """Flattens pip dependencies from possible nested `requirements.txt` files.
 
     Args:
@@ -180,6 +202,8 @@ def flatten_pip_dependencies(
       analyzed_file_dir: Path to directory the dependencies are relative to.
         In practice, this is a parent directory of either a pip requirements
         file or a Conda environment file that contains `pip_dependencies`.
+      req_paths: List the paths of the `requirements.txt` files read are
+        appended to.
 
     Returns:
       List[str]: List with a single pip package (`str`) in each element after
@@ -189,7 +213,8 @@ def flatten_pip_dependencies(
     all_pip_dependencies = []
     for pip_dependency in pip_dependencies:
         all_pip_dependencies.extend(
-                analyze_pip_requirement(pip_dependency, analyzed_file_dir)
+                analyze_pip_requirement(
+                        pip_dependency, analyzed_file_dir, req_paths)
         )
     return all_pip_dependencies
 
@@ -278,21 +303,54 @@ def get_local_pip_dependencies(
     return (local_pip_dependencies, local_pip_deps_names)
 
 
+def conda_environment_exists(name: str) -> bool:
+    """Tests whether a Conda environment with the given name exists.
+
+    Args:
+      name: Name of the Conda environment.
+
+    Returns:
+      bool: True if the environment exists; False otherwise.
+    """
+
+    conda_envs = json.loads(_run('conda env list --json', return_stdout=True))
+    return any(os.path.basename(prefix) == name
+               for prefix in conda_envs['envs'])
+
+
 class CondaEnvironmentContext:
-    """The with-statement context creating a temporary Conda environment."""
-    def __init__(self, name: str, env_path: str):
+    """The with-statement context creating a temporary Conda environment.
+
+    With `keep`, the environment is kept after the context instead, so the next
+      time the existing environment is updated in place (with
+      `conda env update --prune`) rather than created from scratch.
+    """
+    def __init__(self, name: str, env_path: str, keep: bool = False):
         """Inits CondaEnvironmentContext.
 
         Args:
           name: Name to be used for the temporary Conda environment.
           env_path: Path to the Conda `environment.txt` file to be used to
             create the temporary Conda environment.
+          keep: Whether to keep the environment for the next time.
         """
 
         self._name = name
         self._env_path = env_path
+        self.keep = keep
 
     def __enter__(self):
+        if self.keep and conda_environment_exists(self._name):
+            try:
+                _run('conda env update --prune -n ' + self._name + ' -f '
+                     + self._env_path)
+            except subprocess.CalledProcessError:
+                print('ERROR: Updating `' + self._name
+                      + '` environment failed!')
+                print()
+                sys.exit(1)
+            return self
+
         try:
             _run('conda env create -n ' + self._name + ' -f ' + self._env_path)
         except subprocess.CalledProcessError:
@@ -300,23 +358,152 @@ class CondaEnvironmentContext:
             print('Please remove any environment with such name, if exists.')
             print()
             sys.exit(1)
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.keep:
+            print('Keeping `' + self._name + '` Conda environment.')
+            print()
+            return
         print('Removing `' + self._name + '` Conda environment... ', end='')
-        _run('conda env remove -n ' + self._name, stdout=subprocess.DEVNULL,
+        # Newer Conda versions ask for a confirmation without `--yes`
+        _run('conda remove --all --yes -n ' + self._name,
+             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
              stderr=subprocess.DEVNULL)
         print('done!')
         print()
 
 
+@functools.lru_cache()
+def get_pip_versions(pip_cmd: str) -> (Tuple[int, ...], Tuple[int, ...]):
+    """Gets the versions of pip and of the Python interpreter running it.
+
+    The versions are only checked once for each `pip_cmd`.
+
+    Args:
+      pip_cmd: Command to be used to run pip subprocess.
+
+    Returns:
+      Tuple with two elements:
+        Tuple[int, ...]: Version of pip, e.g., `(22, 2, 1)`.
+        Tuple[int, ...]: Version of Python, e.g., `(3, 9)`.
+    """
+
+    # E.g. `pip 22.2.1 from /.../site-packages/pip (python 3.9)`
+    version_match = re.search(
+            r'pip ([\d.]+)\S* from .* \(python ([\d.]+)\)',
+            _run(pip_cmd + '--version', return_stdout=True))
+    return tuple(tuple(int(number) for number in version.strip('.').split('.'))
+                 for version in version_match.groups())
+
+
+def _pip_package_name(pip_spec: str, normalize: bool = True) -> str:
+    """Gets the name of a package from a `requirements.txt` line.
+
+    The name is normalized (PEP 503) unless `normalize` is False.
+    """
+
+    name_match = re.match(r'[A-Za-z0-9][A-Za-z0-9._-]*', pip_spec)
+    if name_match is None:
+        # E.g. `-e` lines, which are kept as they are
+        return pip_spec
+    if not normalize:
+        return name_match.group(0)
+    return re.sub(r'[-_.]+', '-', name_match.group(0)).lower()
+
+
+def format_pip_report_item(install: dict) -> str:
+    """Formats a package from pip's installation report like `pip freeze`.
+
+    Args:
+      install: Item of the `install` list of the report.
+
+    Returns:
+      str: The package in the `requirements.txt` style, e.g., `NAME==VERSION`
+        or `NAME @ git+URL@COMMIT` for direct URL requirements.
+    """
+
+    name = install['metadata']['name']
+    if not install.get('is_direct'):
+        return name + '==' + install['metadata']['version']
+
+    download_info = install['download_info']
+    url = download_info['url']
+    fragments = []
+    if 'vcs_info' in download_info:
+        vcs_info = download_info['vcs_info']
+        url = vcs_info['vcs'] + '+' + url + '@' + vcs_info['commit_id']
+    elif download_info.get('archive_info', {}).get('hash'):
+        fragments.append(download_info['archive_info']['hash'])
+    if download_info.get('subdirectory'):
+        fragments.append('subdirectory=' + download_info['subdirectory'])
+    if fragments:
+        url += '#' + '&'.join(fragments)
+    if download_info.get('dir_info', {}).get('editable'):
+        return '-e ' + url
+    return name + ' @ ' + url
+
+
+def resolve_pip_dependencies(
+        pip_cmd: str, requirements_path: str, root_dir: str,
+        frozen_pkgs: List[str], skipped_pkgs: List[str]) -> List[str]:
+    """Resolves pip dependencies' versions without installing them.
+
+    Runs `pip install --dry-run --report`, so no packages are installed and
+      only the metadata of the packages is downloaded when the index provides
+      it separately.
+
+    Args:
+      pip_cmd: Command to be used to run pip subprocess.
+      requirements_path: Path to the `requirements.txt` file to resolve.
+      root_dir: Root directory to resolve all relative paths with.
+      frozen_pkgs: `pip freeze` output before installing the dependencies.
+      skipped_pkgs: Names of the packages to leave out, e.g., local packages.
+
+    Returns:
+      List[str]: `frozen_pkgs` with the packages pip would install added (or
+        replaced), sorted like `pip freeze` sorts them.
+    """
+
+    (pip_version, python_version) = get_pip_versions(pip_cmd)
+    # `pip freeze` doesn't output these packages.
+    skipped_pkgs = skipped_pkgs + ['pip']
+    if python_version < (3, 12):
+        skipped_pkgs.extend(['setuptools', 'distribute', 'wheel'])
+    skipped_names = {_pip_package_name(pkg) for pkg in skipped_pkgs}
+
+    report_dir = tempfile.mkdtemp()
+    report_path = join(report_dir, 'report.json')
+    try:
+        _run(pip_cmd + 'install --dry-run --quiet --report ' + report_path
+             + ' -r ' + requirements_path, cwd=root_dir or '.')
+        with open(report_path, 'r') as report_file:
+            report = json.load(report_file)
+    finally:
+        shutil.rmtree(report_dir)
+
+    pip_pkgs = {_pip_package_name(pkg): pkg for pkg in frozen_pkgs}
+    for install in report['install']:
+        name = _pip_package_name(install['metadata']['name'])
+        if name not in skipped_names:
+            pip_pkgs[name] = format_pip_report_item(install)
+    return sorted(pip_pkgs.values(),
+                  key=lambda pkg: _pip_package_name(pkg, False).lower())
+
+
 def lock_pip_dependencies(
-        pip_cmd: str, root_dir: str, pip_deps: List[str]) -> List[str]:
+        pip_cmd: str, root_dir: str, pip_deps: List[str],
+        dry_run: bool = False) -> List[str]:
     """Locks pip dependencies' versions.
 
+    With `dry_run`, the dependencies are only resolved (if pip supports
+      `--dry-run --report`, i.e., pip>=22.2) rather than installed.
+
     Args:
       pip_cmd: Command to be used to run pip subprocess.
       root_dir: Root directory to resolve all relative paths with.
       pip_deps: Pip dependencies to lock.
+      dry_run: Whether to resolve the dependencies rather than installing them.
 
     Returns:
       List[str]: List of pip dependencies with locked versions formatted
@@ -330,7 +517,15 @@ def lock_pip_dependencies(
     (local_deps, local_deps_names) = get_local_pip_dependencies(
             all_pip_deps, root_dir)
 
-    print('Installing pip dependencies...')
+    if dry_run and get_pip_versions(pip_cmd)[0] < (22, 2):
+        print('Pip is too old to resolve the dependencies without installing'
+              + ' them (pip>=22.2 is needed).')
+        dry_run = False
+
+    if dry_run:
+        frozen_pkgs = _run(pip_cmd + 'freeze', return_stdout=True).splitlines()
+
+    print(('Resolving' if dry_run else 'Installing') + ' pip dependencies...')
     print()
     tmp_requirements_file = tempfile.NamedTemporaryFile(
             'w', delete=False)
@@ -340,15 +535,21 @@ def lock_pip_dependencies(
         tmp_requirements_file.close()
 
         # Paths in `requirements.txt` are relative to the `root_dir`
-        _run(pip_cmd + 'install -r ' + tmp_requirements_path,
-             cwd=root_dir or '.')
+        if dry_run:
+            # Local packages are left out as they would've been uninstalled
+            frozen_pkgs = resolve_pip_dependencies(
+                    pip_cmd, tmp_requirements_path, root_dir, frozen_pkgs,
+                    local_deps_names)
+        else:
+            _run(pip_cmd + 'install -r ' + tmp_requirements_path,
+                 cwd=root_dir or '.')
     finally:
         if exists(tmp_requirements_path):
             os.remove(tmp_requirements_path)
     print()
 
     # Uninstall local packages
-    if local_deps and local_deps_names:
+    if not dry_run and local_deps and local_deps_names:
         print('Uninstalling local pip packages (they were installed '
               + "only to lock their dependencies' versions)...")
         print()
@@ -356,8 +557,11 @@ def lock_pip_dependencies(
             _run(pip_cmd + 'uninstall --yes ' + local_pkg)
         print()
 
+    if not dry_run:
+        frozen_pkgs = _run(pip_cmd + 'freeze', return_stdout=True).splitlines()
+
     pip_locked_pkgs = []
-    for pip_spec in _run(pip_cmd + 'freeze', return_stdout=True).splitlines():
+    for pip_spec in frozen_pkgs:
         if pip_spec:
             # Ignore pip packages installed by Conda
             # (lines: 'NAME @ file://PATH/work')
@@ -375,15 +579,152 @@ def lock_pip_dependencies(
     return pip_locked_pkgs
 
 
-def render_conda_lock_contents(env_yml_path: str) -> dict:
+# Run with Conda's own Python interpreter to use Conda's channel handling.
+# Prints the configured channels and the canonical names of the channel URLs
+# read from stdin, as `conda env export` writes them.
+_CONDA_CHANNELS_SCRIPT = '''
+import json
+import sys
+from conda.base.context import context, reset_context
+from conda.models.channel import Channel
+reset_context()
+print(json.dumps({
+    'channels': list(context.channels),
+    'canonical_names': {
+        url: Channel(url).canonical_name for url in json.load(sys.stdin)},
+}))
+'''
+
+
+def get_conda_channels(base_urls: List[str]) -> (List[str], Dict[str, str]):
+    """Gets the configured Conda channels and the names of the given channels.
+
+    Args:
+      base_urls: Channel URLs of the packages, e.g., from the solver output.
+
+    Returns:
+      Tuple with two elements:
+        List[str]: Channels configured for Conda (e.g., in `.condarc`).
+        Dict[str, str]: Canonical name of each channel URL from `base_urls`,
+          e.g., `conda-forge` or `defaults`.
+    """
+
+    conda_info = json.loads(_run('conda info --json', return_stdout=True))
+    conda_python = conda_info['sys.executable']
+    channels_info = json.loads(_run(
+            conda_python + ' -c', multiword_last_arg=_CONDA_CHANNELS_SCRIPT,
+            return_stdout=True, input=json.dumps(base_urls)))
+    return (channels_info['channels'], channels_info['canonical_names'])
+
+
+def solve_conda_environment(env_yml: dict,
+                            platform: Optional[str] = None) -> dict:
+    """Solves a Conda environment without creating it.
+
+    Runs `conda create --dry-run --json` with the channels and dependencies
+      from the `environment.yml` contents, so only the repodata is downloaded.
+
+    Nothing is printed, so it can be called from several threads; in case of a
+      failure, the output of Conda is in the raised error's `output`.
+
+    Args:
+      env_yml: Contents of `environment.yml` file without pip dependencies.
+      platform: Conda platform (subdir) to solve the environment for; the
+        current platform if not given.
+
+    Returns:
+      dict: The JSON output of `conda create --dry-run --json`; the `LINK`
+        actions are the packages the environment would contain.
+
+    Raises:
+      subprocess.CalledProcessError: If Conda failed to solve the environment.
+    """
+
+    channels = list(env_yml.get('channels') or [])
+    conda_cmd = 'conda create --dry-run --json -n ' + env_yml['name']
+    # Like `conda env create`, the configured channels are only used if the
+    # `environment.yml` doesn't have `nodefaults` in its channels.
+    if 'nodefaults' in channels:
+        channels.remove('nodefaults')
+        conda_cmd += ' --override-channels'
+    for channel in channels:
+        conda_cmd += ' -c ' + channel
+
+    conda_env = None
+    if platform is not None:
+        conda_env = dict(os.environ, CONDA_SUBDIR=platform)
+
+    # Dependencies can contain spaces (e.g. `python >=3.8`). They aren't
+    # passed with `--file` which reads `python=3.8` as `python==3.8`.
+    return json.loads(_run(
+            conda_cmd + ' --',
+            multiword_last_arg=[str(dep) for dep in env_yml['dependencies']],
+            return_stdout=True, quiet=True, env=conda_env))
+
+
+def render_solved_conda_lock(env_yml: dict, solution: dict) -> dict:
+    """Renders Conda Lock contents from the solved environment.
+
+    The packages aren't downloaded nor installed. The contents are the same as
+      `conda env export` outputs for the environment created from `env_yml`.
+
+    Args:
+      env_yml: Contents of `environment.yml` file without pip dependencies.
+      solution: Output of `solve_conda_environment` for `env_yml`.
+
+    Returns:
+      dict: Conda Lock contents in a ruamel.yaml.comments.CommentedMap.
+    """
+
+    packages = sorted(solution['actions'].get('LINK', []),
+                      key=lambda pkg: pkg['name'])
+    (channels, canonical_names) = get_conda_channels(
+            sorted({pkg['base_url'] for pkg in packages}))
+
+    # `conda env export` lists the configured channels, preceded by the
+    # channels of the packages which aren't in them.
+    for package in packages:
+        channel = canonical_names[package['base_url']]
+        if channel not in channels:
+            channels.insert(0, channel)
+
+    conda_lock_yaml = CommentedMap()
+    conda_lock_yaml['name'] = env_yml['name']
+    conda_lock_yaml['channels'] = channels
+    conda_lock_yaml['dependencies'] = [
+            pkg['name'] + '=' + pkg['version'] + '=' + pkg['build_string']
+            for pkg in packages]
+    if env_yml.get('variables'):
+        conda_lock_yaml['variables'] = env_yml['variables']
+    conda_lock_yaml['prefix'] = solution['prefix']
+    print('Conda packages captured.')
+    print()
+
+    # The output of `conda env export` ends with an empty line, which is kept
+    # in the Conda Lock.
+    with io.StringIO() as tmp_stream:
+        yaml.dump(conda_lock_yaml, tmp_stream)
+        return yaml.load(tmp_stream.getvalue() + '\n')
+
+
+def render_conda_lock_contents(env_yml_path: str, dry_run: bool = False,
+                               warm_env: Optional[str] = None) -> dict:
     """Renders Conda Lock contents based on the Conda `environment.yml` file.
 
     Conda Lock is an `environment.yml`-like file with locked dependencies which
       can be used to create a Conda environment with `conda env create -f`.
 
+    With `dry_run`, the Conda packages are only solved, without creating the
+      environment. A temporary environment is still created when there are pip
+      dependencies, to install them. If `warm_env` is given, the environment
+      with this name is used instead. It is kept and updated to the solved
+      packages each time.
+
     Args:
       env_yml_path: Path to the `environment.yml` file to be the base for the
         Conda Lock.
+      dry_run: Whether to solve the environment rather than creating it.
+      warm_env: Name of the environment to keep for the pip dependencies.
 
     Returns:
       dict: Conda Lock contents in a ruamel.yaml.comments.CommentedMap, i.e.,
@@ -393,6 +734,39 @@ def render_conda_lock_contents(env_yml_path: str) -> dict:
 
     (pipless_env_yml, pip_deps) = separate_pip_deps_from_env_yml(env_yml_path)
     env_name = pipless_env_yml['name']
+    if warm_env == env_name:
+        print('ERROR: The warm environment needs another name than `'
+              + env_name + '`!')
+        sys.exit(1)
+
+    conda_lock_yaml = None
+    if dry_run and (warm_env or not pip_deps):
+        print('Solving `' + env_name + '` Conda environment...')
+        try:
+            solution = solve_conda_environment(pipless_env_yml)
+        except subprocess.CalledProcessError as error:
+            print(error.output)
+            print('ERROR: Solving `' + env_name + '` environment failed!')
+            print()
+            sys.exit(1)
+        print()
+        conda_lock_yaml = render_solved_conda_lock(pipless_env_yml, solution)
+        if not pip_deps:
+            return conda_lock_yaml
+
+        # `conda env update` keeps the installed versions of the packages
+        # when it can, so the warm environment gets the solved packages.
+        env_name = warm_env
+        pipless_env_yml = CommentedMap()
+        pipless_env_yml['name'] = warm_env
+        pipless_env_yml['channels'] = conda_lock_yaml['channels']
+        pipless_env_yml['dependencies'] = conda_lock_yaml['dependencies']
+        print('The environment has pip dependencies; `' + warm_env
+              + '` environment will be used.')
+        print()
+    elif dry_run:
+        print('The environment has pip dependencies; it will be created.')
+        print()
 
     pipless_env_file = tempfile.NamedTemporaryFile(
             'w', suffix='.yml', delete=False)
@@ -401,20 +775,30 @@ def render_conda_lock_contents(env_yml_path: str) -> dict:
         yaml.dump(pipless_env_yml, pipless_env_file)
         pipless_env_file.close()
 
-        with CondaEnvironmentContext(env_name, pipless_env_path):
-            conda_lock = _run('conda run -n ' + env_name + ' conda env export',
-                              return_stdout=True)
-            conda_lock_yaml = yaml.load(conda_lock)
-            print('Conda packages captured.')
-            print()
+        with CondaEnvironmentContext(env_name, pipless_env_path,
+                                     keep=env_name == warm_env) as environment:
+            if conda_lock_yaml is None:
+                conda_lock = _run(
+                        'conda run -n ' + env_name + ' conda env export',
+                        return_stdout=True)
+                conda_lock_yaml = yaml.load(conda_lock)
+                print('Conda packages captured.')
+                print()
 
             # Lock pip dependencies
             if pip_deps:
                 pip_command = ('conda run --no-capture-output -n ' + env_name
                                + ' python3 -I -m pip ')
 
+                # `conda env update --prune` doesn't remove pip packages
+                if (environment.keep
+                        and get_pip_versions(pip_command)[0] < (22, 2)):
+                    print('Pip packages will be installed; `' + env_name
+                          + "` environment won't be kept.")
+                    environment.keep = False
+
                 pip_locked_pkgs = lock_pip_dependencies(
-                        pip_command, dirname(env_yml_path), pip_deps)
+                        pip_command, dirname(env_yml_path), pip_deps, dry_run)
 
                 # Add locked pip packages to the `conda env export` yaml output
                 if pip_locked_pkgs:
@@ -431,6 +815,210 @@ def render_conda_lock_contents(env_yml_path: str) -> dict:
             os.remove(pipless_env_path)
 
 
+def get_platform_lock_path(conda_lock_path: str, platform: str) -> str:
+    """Gets the path of the Conda Lock for a platform.
+
+    Args:
+      conda_lock_path: Path to the Conda Lock, e.g., `conda_lock.yml`.
+      platform: Conda platform (subdir), e.g., `linux-64`.
+
+    Returns:
+      str: Path with the platform before the extension, e.g.,
+        `conda_lock.linux-64.yml`.
+    """
+
+    (root, ext) = splitext(conda_lock_path)
+    return root + '.' + platform + ext
+
+
+def render_platform_conda_locks(
+        env_yml_path: str, platforms: List[str],
+        jobs: Optional[int] = None,
+        warm_env: Optional[str] = None) -> Dict[str, dict]:
+    """Renders Conda Lock contents for each platform by solving the environment.
+
+    The environment is solved for the platforms concurrently, with Conda's
+      `CONDA_SUBDIR`, so the platforms don't need to match the current one.
+
+    Pip dependencies can only be resolved for the current platform, so they
+      are resolved as by `render_conda_lock_contents` and the resulting pip
+      packages are added to the Conda Locks of all the platforms.
+
+    Args:
+      env_yml_path: Path to the `environment.yml` file to be the base for the
+        Conda Locks.
+      platforms: Conda platforms (subdirs) to lock the environment for, e.g.,
+        `linux-64` or `osx-arm64`.
+      jobs: Maximum number of platforms solved at the same time; all of them
+        if not given.
+      warm_env: Name of the environment to keep for the pip dependencies.
+
+    Returns:
+      Dict[str, dict]: Conda Lock contents for each platform.
+    """
+
+    (pipless_env_yml, pip_deps) = separate_pip_deps_from_env_yml(env_yml_path)
+    if pip_deps:
+        print('WARNING: Pip dependencies can only be resolved for the current'
+              + ' platform; the same pip packages will be used for all the'
+              + ' platforms!')
+        print()
+
+    env_name = pipless_env_yml['name']
+    durations = {}
+
+    # Only the main thread prints, so the output of the platforms isn't mixed.
+    def solve(platform: str) -> dict:
+        start = time.monotonic()
+        try:
+            return solve_conda_environment(pipless_env_yml, platform)
+        finally:
+            durations[platform] = time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs or len(platforms)) as executor:
+        futures = []
+        for platform in platforms:
+            print('Solving `' + env_name + '` Conda environment for '
+                  + platform + '...')
+            futures.append(executor.submit(solve, platform))
+        print()
+
+        solutions = {}
+        for (platform, future) in zip(platforms, futures):
+            try:
+                solutions[platform] = future.result()
+            except subprocess.CalledProcessError as error:
+                print(error.output)
+                print('ERROR: Solving `' + env_name + '` environment for '
+                      + platform + ' failed!')
+                print()
+    if len(solutions) != len(platforms):
+        sys.exit(1)
+
+    conda_locks = {}
+    for (platform, solution) in solutions.items():
+        print('Rendering Conda Lock for ' + platform + '...')
+        conda_locks[platform] = render_solved_conda_lock(
+                pipless_env_yml, solution)
+
+    print('Solving times:')
+    for platform in platforms:
+        print('* {}: {:.1f}s'.format(platform, durations[platform]))
+    print()
+
+    if pip_deps:
+        print('Resolving pip dependencies for the current platform...')
+        print()
+        current_lock = render_conda_lock_contents(env_yml_path, True, warm_env)
+        pip_sections = [dep for dep in current_lock['dependencies']
+                        if isinstance(dep, dict) and 'pip' in dep]
+        for conda_lock in conda_locks.values():
+            conda_lock['dependencies'].extend(copy.deepcopy(pip_sections))
+    return conda_locks
+
+
+def get_input_paths(env_yml_path: str) -> List[str]:
+    """Gets the paths of the files the Conda Lock is rendered from.
+
+    Args:
+      env_yml_path: Path to the `environment.yml` file.
+
+    Returns:
+      List[str]: `env_yml_path` and the paths of the pip requirements files it
+        includes.
+    """
+
+    input_paths = [env_yml_path]
+    (_, pip_deps) = separate_pip_deps_from_env_yml(env_yml_path)
+    if pip_deps:
+        flatten_pip_dependencies(pip_deps, dirname(env_yml_path), input_paths)
+    return input_paths
+
+
+def hash_input_files(env_yml_path: str) -> str:
+    """Computes the hash of the files the Conda Lock is rendered from.
+
+    It's part of the key of the cache, so a run restores the cache saved by
+      the last run with the same files given by `get_input_paths`.
+
+    Args:
+      env_yml_path: Path to the `environment.yml` file.
+
+    Returns:
+      str: Hex digest of the paths and the contents of the files.
+    """
+
+    input_hash = hashlib.sha256()
+    for input_path in get_input_paths(env_yml_path):
+        input_hash.update(input_path.encode('utf-8') + b'\0')
+        try:
+            with open(input_path, 'rb') as input_file:
+                input_hash.update(
+                        hashlib.sha256(input_file.read()).digest())
+        except FileNotFoundError:
+            input_hash.update(b'-')
+    return input_hash.hexdigest()
+
+
+def compute_inputs_fingerprint(
+        env_yml_path: str, lock_paths: List[str], settings: List[str]) -> str:
+    """Computes the fingerprint of the inputs of the Conda Lock rendering.
+
+    The fingerprint covers the `environment.yml` file, the pip requirements
+      files it includes, the configured Conda channels, the `settings` and the
+      current Conda Locks.
+
+    Args:
+      env_yml_path: Path to the `environment.yml` file.
+      lock_paths: Paths to the Conda Locks rendered from `env_yml_path`.
+      settings: Other values the Conda Locks depend on, e.g., the platforms.
+
+    Returns:
+      str: Hex digest of the inputs.
+    """
+
+    fingerprint = hashlib.sha256()
+
+    def add(label: str, data: Optional[bytes]):
+        # `None` is for missing files
+        fingerprint.update(label.encode('utf-8') + b'\0')
+        fingerprint.update(b'-' if data is None else
+                           hashlib.sha256(data).hexdigest().encode('utf-8'))
+
+    def add_file(path: str):
+        try:
+            with open(path, 'rb') as input_file:
+                add(path, input_file.read())
+        except FileNotFoundError:
+            add(path, None)
+
+    add('input files', hash_input_files(env_yml_path).encode('utf-8'))
+    add('channels', _run('conda config --show channels --json',
+                         return_stdout=True).encode('utf-8'))
+    add('settings', '\n'.join(settings).encode('utf-8'))
+    for lock_path in lock_paths:
+        add_file(lock_path)
+    return fingerprint.hexdigest()
+
+
+def get_fingerprint_path(cache_dir: str, conda_lock_path: str) -> str:
+    """Gets the path of the file storing the fingerprint of a Conda Lock.
+
+    The file holds the fingerprint of the inputs after the last update and the
+      time of the last update (seconds since the epoch) on the next line.
+
+    Args:
+      cache_dir: Directory storing the fingerprints.
+      conda_lock_path: Path to the Conda Lock.
+
+    Returns:
+      str: Path to the fingerprint file in `cache_dir`.
+    """
+
+    lock_name = os.path.normpath(conda_lock_path).replace(os.sep, '_')
+    return join(cache_dir, lock_name + '.fingerprint')
+
+
 def is_conda_lock_extension_correct(conda_lock_path: str) -> bool:
     """Tests whether Conda Lock has a proper extension.
 
@@ -459,6 +1047,21 @@ def main():
     print('Environment variables used are:')
     conda_lock_path = _get_env('BOT_CONDA_LOCK')
     env_yml_path = _get_env('BOT_ENV_YML')
+    dry_run = os.environ.get('BOT_DRY_RUN', 'false').lower() == 'true'
+    print('* BOT_DRY_RUN: ' + str(dry_run).lower())
+    platforms = os.environ.get('BOT_PLATFORMS', '').split()
+    jobs = int(os.environ.get('BOT_JOBS') or 0) or None
+    if platforms:
+        print('* BOT_PLATFORMS: ' + ' '.join(platforms))
+        print('* BOT_JOBS: ' + str(jobs or len(platforms)))
+    cache_dir = os.path.expanduser(os.environ.get('BOT_CACHE_DIR', ''))
+    max_age = float(os.environ.get('BOT_MAX_AGE') or 24)
+    if cache_dir:
+        print('* BOT_CACHE_DIR: ' + cache_dir)
+        print('* BOT_MAX_AGE: ' + str(max_age))
+    warm_env = os.environ.get('BOT_WARM_ENV') or None
+    if warm_env:
+        print('* BOT_WARM_ENV: ' + warm_env)
     print()
     if None in [conda_lock_path, env_yml_path]:
         sys.exit(1)
@@ -466,15 +1069,78 @@ def main():
     if not is_conda_lock_extension_correct(conda_lock_path):
         sys.exit(1)
 
-    conda_lock_yaml = render_conda_lock_contents(env_yml_path)
+    if platforms and not dry_run:
+        print('ERROR: Locking for a list of platforms needs BOT_DRY_RUN!')
+        sys.exit(1)
+
+    if warm_env and not dry_run:
+        print('ERROR: Keeping a warm environment needs BOT_DRY_RUN!')
+        sys.exit(1)
+
+    if cache_dir:
+        # Downloaded Conda packages and pip wheels are kept in the cache
+        abs_cache_dir = os.path.abspath(cache_dir)
+        os.environ.setdefault('CONDA_PKGS_DIRS', join(abs_cache_dir, 'pkgs'))
+        os.environ.setdefault('PIP_CACHE_DIR', join(abs_cache_dir, 'pip'))
+
+    lock_paths = [get_platform_lock_path(conda_lock_path, platform)
+                  for platform in platforms] or [conda_lock_path]
+    settings = [str(dry_run)] + platforms
+    if cache_dir:
+        fingerprint_path = get_fingerprint_path(cache_dir, conda_lock_path)
+        fingerprint = compute_inputs_fingerprint(
+                env_yml_path, lock_paths, settings)
+        if exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as fingerprint_file:
+                last_update = fingerprint_file.read().split()
+            # Files without the time of the last update are too old
+            if last_update[:1] == [fingerprint]:
+                age = time.time() - float(last_update[1]
+                                          if len(last_update) > 1 else 0)
+                if age < max_age * 3600:
+                    print('The inputs are unchanged since the last update'
+                          + ' (fingerprint ' + fingerprint + ').')
+                    print('Conda Lock is up to date.')
+                    sys.exit(3)
+                print('The inputs are unchanged but the last update was'
+                      + ' {:.1f} hours ago.'.format(age / 3600))
+                print()
+
+    if platforms:
+        conda_locks = {
+            get_platform_lock_path(conda_lock_path, platform): lock_yml
+            for (platform, lock_yml) in render_platform_conda_locks(
+                    env_yml_path, platforms, jobs, warm_env).items()}
+    else:
+        conda_locks = {
+            conda_lock_path: render_conda_lock_contents(
+                    env_yml_path, dry_run, warm_env)}
 
     # Apply yaml offset used by `conda env export`
     yaml.indent(offset=2)
-    if try_updating_lock_file(conda_lock_path, conda_lock_yaml):
+    updated = False
+    for (lock_path, lock_yml) in conda_locks.items():
+        if try_updating_lock_file(lock_path, lock_yml):
+            updated = True
+
+    if cache_dir:
+        # The fingerprint includes the updated Conda Locks
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(fingerprint_path, 'w') as fingerprint_file:
+            fingerprint_file.write(compute_inputs_fingerprint(
+                    env_yml_path, lock_paths, settings) + '\n')
+            fingerprint_file.write('{:.0f}\n'.format(time.time()))
+
+    if updated:
         sys.exit(0)
     else:
         sys.exit(3)
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--hash-inputs']:
+        # Key of the cache, see action.yml
+        print(hash_input_files(os.environ.get('BOT_ENV_YML',
+                                              'environment.yml')))
+    else:
+        main()
@@ -23,7 +23,8 @@ set -e
 
 gstart "Update Conda Lock"
 EXIT_CODE=0
-# Uses BOT_CONDA_LOCK and BOT_ENV_YML env. vars
+# Uses BOT_CONDA_LOCK, BOT_ENV_YML, BOT_DRY_RUN, BOT_PLATFORMS, BOT_JOBS,
+# BOT_CACHE_DIR, BOT_MAX_AGE and BOT_WARM_ENV env. vars
 python3 $GITHUB_ACTION_PATH/update_lock.py || EXIT_CODE=$?
 gend
 